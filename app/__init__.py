@@ -1,14 +1,22 @@
-from flask import Flask, Response
-from sqlalchemy import create_engine
+from flask import Flask, Response, jsonify
+import click
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from pathlib import Path
 import os
+import tempfile
 
+from .cache import BackgroundRefresh, RenderCache, SingleFlight, VersionedValue
+from .jobs import ExportJobs, ImportJobs
+from .publish import Publisher, publish
+from .search import NumberIndex, PrefixIndex, setup_search
+from .telemetry import PollStats
 from .routes import main_bp
 from .routes_xml import xml_bp
 from .routes_api import api_bp
 from .routes_export import export_bp
-from .models import Base, Contact, import_contacts_xml
+from .importer import import_contacts_xml
+from .models import Base, Contact, ensure_data_version, get_data_version
 from .utils import PHONE_RE
 
 def create_app(test_config=None):
@@ -18,15 +26,73 @@ def create_app(test_config=None):
         SECRET_KEY='dev',
         SQLALCHEMY_DATABASE_URI=os.environ.get('SQLALCHEMY_DATABASE_URI', f'sqlite:///{default_db}'),
         INITIAL_PHONEBOOK_XML=os.environ.get('INITIAL_PHONEBOOK_XML', '/data/phonebook.xml'),
+        # entries per Yealink directory page; 0 serves each directory unpaged
+        PHONEBOOK_PAGE_SIZE=int(os.environ.get('PHONEBOOK_PAGE_SIZE', 0)),
+        # contacts per page of the web interface
+        CONTACTS_PAGE_SIZE=int(os.environ.get('CONTACTS_PAGE_SIZE', 50)),
+        # add an A-Z letter-range submenu to root.xml
+        PHONEBOOK_ALPHA_INDEX=os.environ.get('PHONEBOOK_ALPHA_INDEX', '').lower() in ('1', 'true', 'yes'),
+        # write static phonebook files here after every change (disabled if unset)
+        PUBLISH_DIR=os.environ.get('PUBLISH_DIR'),
+        # seconds a request waits for a concurrent render before rendering itself
+        SINGLE_FLIGHT_TIMEOUT=float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 10)),
+        # directories with more active contacts are streamed from the database
+        # on every request instead of being rendered together and cached
+        RENDER_CACHE_MAX_ROWS=int(os.environ.get('RENDER_CACHE_MAX_ROWS', 20000)),
+        # where background export jobs keep their zip bundles and status files;
+        # must be shared by all worker processes
+        EXPORT_DIR=os.environ.get('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'phonebook-exports')),
+        EXPORT_JOB_WORKERS=int(os.environ.get('EXPORT_JOB_WORKERS', 1)),
+        # rows per INSERT statement of an import, optionally committed one by one
+        IMPORT_BATCH_SIZE=int(os.environ.get('IMPORT_BATCH_SIZE', 5000)),
+        IMPORT_COMMIT_BATCHES=os.environ.get('IMPORT_COMMIT_BATCHES', '').lower() in ('1', 'true', 'yes'),
+        # uploads and import job status are spooled here (shared by all worker
+        # processes); larger ones than the inline limit import in the background
+        IMPORT_SPOOL_DIR=os.environ.get('IMPORT_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'phonebook-imports')),
+        IMPORT_INLINE_MAX_BYTES=int(os.environ.get('IMPORT_INLINE_MAX_BYTES', 1024 * 1024)),
+        IMPORT_JOB_WORKERS=int(os.environ.get('IMPORT_JOB_WORKERS', 1)),
+        # trailing digits that must agree for a caller-ID suffix match
+        LOOKUP_SUFFIX_DIGITS=int(os.environ.get('LOOKUP_SUFFIX_DIGITS', 9)),
     )
 
     if test_config:
         app.config.update(test_config)
 
-    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'], connect_args={"check_same_thread": False})
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    connect_args = {"check_same_thread": False} if uri.startswith('sqlite') else {}
+    engine = create_engine(uri, connect_args=connect_args)
     Session = sessionmaker(bind=engine)
     app.config['SESSION_FACTORY'] = Session
+    app.config['RENDER_CACHE'] = RenderCache()
+    app.config['RENDER_FLIGHTS'] = SingleFlight()
+    app.config['POLL_STATS'] = PollStats()
+    app.config['PREFIX_INDEX'] = VersionedValue(lambda: PrefixIndex.load(Session))
+    app.config['NUMBER_INDEX'] = VersionedValue(
+        lambda: NumberIndex.load(Session, app.config['LOOKUP_SUFFIX_DIGITS'])
+    )
+
+    def _warm_number_index():
+        if not app.config['NUMBER_INDEX'].loaded:
+            return
+        session = Session()
+        try:
+            version, _ = get_data_version(session)
+        finally:
+            session.close()
+        app.config['NUMBER_INDEX'].get(version)
+
+    # rebuild the caller-ID index after writes instead of on the next call
+    app.config['LOOKUP_WARMER'] = BackgroundRefresh(_warm_number_index, 'phonebook-lookup-index', app.logger)
+    app.config['EXPORT_JOBS'] = ExportJobs(Session, app.config['EXPORT_DIR'], app.config['EXPORT_JOB_WORKERS'])
+    app.config['IMPORT_JOBS'] = ImportJobs(
+        Session,
+        app.config['IMPORT_SPOOL_DIR'],
+        app.config['IMPORT_JOB_WORKERS'],
+        app.config['IMPORT_BATCH_SIZE'],
+        app.config['IMPORT_COMMIT_BATCHES'],
+    )
     Base.metadata.create_all(engine)
+    app.config['SEARCH_BACKEND'] = setup_search(engine)
     app.config['DB_PATH'] = Path(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///',''))
 
     # perform auto-import from Yealink XML if DB is empty
@@ -34,6 +100,7 @@ def create_app(test_config=None):
         return session.query(Contact).count() == 0
 
     session = Session()
+    ensure_data_version(session)
     if _needs_import(session):
         xml_path = Path(app.config.get("INITIAL_PHONEBOOK_XML", "/data/phonebook.xml"))
         if xml_path.is_file():
@@ -55,8 +122,41 @@ def create_app(test_config=None):
     app.register_blueprint(api_bp)
     app.register_blueprint(export_bp)
 
+    # background refreshes requested after every committed phonebook write
+    on_change = [app.config['LOOKUP_WARMER']]
+    if app.config['PUBLISH_DIR']:
+        publisher = Publisher(app)
+        app.config['PUBLISHER'] = publisher
+        on_change.append(publisher)
+        publisher.request()
+
+    @event.listens_for(Session, 'after_commit')
+    def _refresh_after_commit(session):
+        if session.info.pop('phonebook_changed', False):
+            for refresh in on_change:
+                refresh.request()
+
+    @event.listens_for(Session, 'after_rollback')
+    def _discard_change_flag(session):
+        session.info.pop('phonebook_changed', None)
+
+    @app.cli.command('publish')
+    def publish_command():
+        """Regenerate all static phonebook files in PUBLISH_DIR."""
+        if not app.config['PUBLISH_DIR']:
+            raise click.ClickException('PUBLISH_DIR is not configured.')
+        version = publish(app, force=True)
+        click.echo(f"Published data version {version} to {app.config['PUBLISH_DIR']}")
+
     @app.route("/health", methods=["GET"])
     def health():
         return Response("OK", status=200, mimetype="text/plain")
 
+    @app.route("/stats", methods=["GET"])
+    def stats():
+        return jsonify({
+            'single_flight': app.config['RENDER_FLIGHTS'].stats(),
+            'polls': app.config['POLL_STATS'].snapshot(),
+        })
+
     return app
@@ -0,0 +1,383 @@
+"""Caching helpers for rendered phonebook artifacts.
+
+Everything here is keyed by the persisted change sequence from
+:func:`app.models.get_data_version`, so all workers agree on what is current.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from threading import Event, Lock, Thread
+from typing import Callable, Iterable, Iterator
+import gzip
+import zlib
+
+from flask import Response, current_app, request
+
+from .models import get_data_version
+
+# Artifacts are compressed once per data version, so spend the CPU on ratio.
+GZIP_LEVEL = 9
+
+
+class RenderCache:
+    """Store rendered bytes per key for the newest data version seen.
+
+    Each entry keeps the plain bytes and a gzip-compressed copy, both made
+    once per version.  Callers pass the data version they read *before*
+    rendering.  Entries for older versions are dropped as soon as a newer
+    version is stored, so a lookup returns either bytes matching the
+    requested version or ``None``.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._version = 0
+        self._entries: dict[str, tuple[int, bytes, bytes]] = {}
+
+    def get(self, key: str, version: int, encoding: str | None = None) -> bytes | None:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[2] if encoding == 'gzip' else entry[1]
+        return None
+
+    def put(self, key: str, version: int, data: bytes, gzipped: bytes | None = None) -> None:
+        if gzipped is None:
+            gzipped = gzip.compress(data, GZIP_LEVEL, mtime=0)
+        with self._lock:
+            if version < self._version:
+                return
+            if version > self._version:
+                self._version = version
+                self._entries.clear()
+            self._entries[key] = (version, data, gzipped)
+
+    def fill(
+        self,
+        key: str,
+        version: int,
+        chunks: Iterable[bytes],
+        encoding: str | None = None,
+    ) -> Iterator[bytes]:
+        """Pass ``chunks`` through and store the result once it completes.
+
+        Output is compressed on the fly; with ``encoding='gzip'`` the
+        compressed stream is yielded instead of the plain chunks.  An aborted
+        stream (e.g. a client disconnect) is never stored.
+        """
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        plain: list[bytes] = []
+        packed: list[bytes] = []
+        try:
+            for chunk in chunks:
+                plain.append(chunk)
+                out = compressor.compress(chunk)
+                packed.append(out)
+                if encoding != 'gzip':
+                    yield chunk
+                elif out:
+                    yield out
+            out = compressor.flush()
+            packed.append(out)
+            if encoding == 'gzip':
+                yield out
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        self.put(key, version, b''.join(plain), b''.join(packed))
+
+
+class VersionedValue:
+    """Hold a single value derived from the data, rebuilt per data version.
+
+    Used for in-process indexes that are expensive to build but cheap to
+    query; concurrent callers for a new version build it only once.
+    """
+
+    def __init__(self, build: Callable[[], object]) -> None:
+        self._build = build
+        self._lock = Lock()
+        self._state: tuple[int, object] | None = None
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the value was built at all, i.e. is worth keeping warm."""
+        return self._state is not None
+
+    def get(self, version: int):
+        state = self._state
+        if state is not None and state[0] == version:
+            return state[1]
+        with self._lock:
+            state = self._state
+            if state is None or state[0] != version:
+                state = (version, self._build())
+                self._state = state
+        return state[1]
+
+
+class BackgroundRefresh:
+    """Run ``refresh`` in a background thread whenever it is requested.
+
+    Requests are coalesced: any number of requests arriving while a run is
+    in progress trigger exactly one more run, so bursts of writes do not
+    queue up rebuilds.
+    """
+
+    def __init__(self, refresh: Callable[[], object], name: str, logger=None) -> None:
+        self._refresh = refresh
+        self._name = name
+        self._logger = logger
+        self._lock = Lock()
+        self._pending = False
+        self._thread: Thread | None = None
+
+    def request(self) -> None:
+        with self._lock:
+            self._pending = True
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+
+    def wait(self, timeout: float | None = None) -> None:
+        """Block until no run is pending (used by tests)."""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._pending = False
+            try:
+                self._refresh()
+            except Exception:
+                if self._logger is not None:
+                    self._logger.exception('%s failed', self._name)
+
+
+class SingleFlight:
+    """Coalesce concurrent renders of the same artifact within a process.
+
+    The first caller for a flight key becomes the leader and renders; later
+    callers get an :class:`~threading.Event` to wait on until the leader has
+    filled the cache.  Counters record how often coalescing kicked in.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._flights: dict[str, Event] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def begin(self, key: str) -> Event | None:
+        """Return ``None`` if the caller leads ``key``, else the event to wait on."""
+        with self._lock:
+            event = self._flights.get(key)
+            if event is None:
+                self._flights[key] = Event()
+                self.leaders += 1
+                return None
+            self.coalesced += 1
+            return event
+
+    def end(self, key: str) -> None:
+        with self._lock:
+            event = self._flights.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def wait(self, event: Event, timeout: float) -> bool:
+        if event.wait(timeout):
+            return True
+        with self._lock:
+            self.timeouts += 1
+        return False
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+                'in_flight': len(self._flights),
+            }
+
+
+class _FlightStream:
+    """Iterate ``chunks`` and end the flight when done, failed or closed.
+
+    A plain generator would not run its cleanup if the server closes it
+    before the first chunk, leaving followers waiting until their timeout.
+    """
+
+    def __init__(self, flights: SingleFlight, key: str, chunks: Iterable[bytes]) -> None:
+        self._flights = flights
+        self._key = key
+        self._chunks = iter(chunks)
+
+    def __iter__(self) -> '_FlightStream':
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self._flights.end(self._key)
+            raise
+
+    def close(self) -> None:
+        try:
+            close = getattr(self._chunks, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._flights.end(self._key)
+
+    # safety net for servers (and test clients) that drop the body unclosed
+    __del__ = close
+
+
+def data_version() -> tuple[int, datetime]:
+    """Look up the current ``(version, updated_at)`` with a short-lived session."""
+    session = current_app.config['SESSION_FACTORY']()
+    try:
+        return get_data_version(session)
+    finally:
+        session.close()
+
+
+def validator_headers(
+    key: str,
+    version: int,
+    last_modified: datetime,
+    encoding: str | None = None,
+) -> dict[str, str]:
+    """Return ETag and Last-Modified headers for artifact ``key``.
+
+    Each content encoding gets its own strong ETag.
+    """
+    suffix = f'-{encoding}' if encoding else ''
+    return {
+        'ETag': f'"{key}-{version}{suffix}"',
+        'Last-Modified': format_datetime(last_modified, usegmt=True),
+    }
+
+
+def not_modified(headers: dict[str, str], last_modified: datetime) -> bool:
+    """Evaluate the request's conditional headers against our validators.
+
+    ``If-None-Match`` takes precedence over ``If-Modified-Since`` as required
+    by RFC 9110.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(headers['ETag'].strip('"'))
+    ims = request.headers.get('If-Modified-Since')
+    if ims:
+        try:
+            return parsedate_to_datetime(ims) >= last_modified
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def conditional_response(
+    key: str,
+    render: Callable[[int], Response],
+    encoding: str | None = None,
+    headers: dict[str, str] | None = None,
+) -> Response:
+    """Answer a conditional GET for ``key`` before anything is rendered.
+
+    ``render`` receives the data version and builds the full response; it is
+    only called when the client's copy is out of date.  ``headers`` are added
+    to both the full and the 304 response.
+    """
+    version, last_modified = data_version()
+    headers = {**(headers or {}), **validator_headers(key, version, last_modified, encoding)}
+    if not_modified(headers, last_modified):
+        return Response(status=304, headers=headers)
+    response = render(version)
+    response.headers.update(headers)
+    return response
+
+
+def preferred_encoding() -> str | None:
+    """Return ``'gzip'`` when the client accepts it, else ``None``."""
+    return 'gzip' if request.accept_encodings['gzip'] else None
+
+
+def artifact_response(
+    key: str,
+    render: Callable[[Callable[[dict[str, bytes]], None]], Iterable[bytes]],
+    content_type: str,
+    headers: dict[str, str] | None = None,
+    flight: str | None = None,
+    change_token: bool = False,
+    bypass: Callable[[], Iterable[bytes] | None] | None = None,
+) -> Response:
+    """Serve the cached artifact ``key``, rendering it only when needed.
+
+    Conditional requests are answered from the persisted data version alone.
+    A cache hit sends the stored plain or gzip bytes, picked by
+    ``Accept-Encoding``.  On a miss ``render(store)`` is streamed to the
+    client while the render cache is filled; renderers that produce sibling
+    artifacts in the same pass hand them to ``store`` to be cached as well.
+
+    Concurrent misses are coalesced per ``flight`` (default: ``key``; use a
+    shared name for artifacts rendered by the same pass): one request
+    renders, the others wait for the cache to be filled.
+
+    On a miss ``bypass()``, when given, may return a body to stream plain
+    and uncached instead: artifacts too large to hold in memory are read
+    straight from the database by every request that misses.
+
+    With ``change_token`` full responses carry the data version they were
+    rendered from in ``X-Change-Token``, the starting point for ``?since=``.
+    """
+    cache = current_app.config['RENDER_CACHE']
+    flights = current_app.config['RENDER_FLIGHTS']
+    timeout = current_app.config['SINGLE_FLIGHT_TIMEOUT']
+    encoding = preferred_encoding()
+
+    def _build(version: int) -> Response:
+        body = cache.get(key, version, encoding)
+        if body is None and bypass is not None:
+            uncached = bypass()
+            if uncached is not None:
+                response = Response(uncached, content_type=content_type)
+                if change_token:
+                    response.headers['X-Change-Token'] = str(version)
+                return response
+        flight_key = f'{flight or key}@{version}'
+        waiter = flights.begin(flight_key) if body is None else None
+        if waiter is not None and flights.wait(waiter, timeout):
+            body = cache.get(key, version, encoding)
+        if body is None:
+            def _store(artifacts: dict[str, bytes]) -> None:
+                for name, data in artifacts.items():
+                    cache.put(name, version, data)
+
+            try:
+                body = cache.fill(key, version, render(_store), encoding)
+            except BaseException:
+                if waiter is None:
+                    flights.end(flight_key)
+                raise
+            if waiter is None:
+                body = _FlightStream(flights, flight_key, body)
+        response = Response(body, content_type=content_type)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if change_token:
+            response.headers['X-Change-Token'] = str(version)
+        return response
+
+    headers = {**(headers or {}), 'Vary': 'Accept-Encoding'}
+    return conditional_response(key, _build, encoding, headers)
@@ -0,0 +1,482 @@
+"""Background jobs for export bundles and file imports.
+
+Building an export bundle or importing a large file runs in a worker thread
+so no request is tied up while the whole database is rendered or written.
+Finished bundles are stored under ``EXPORT_DIR`` named after the data
+version they were rendered from and are handed out again until the data
+changes.  Uploads are spooled to ``IMPORT_SPOOL_DIR`` before they are
+imported.
+
+The state of every job is also written to a status file next to its data,
+so a follow-up request served by another worker process finds the job as
+long as the directories are shared between the workers.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Event, Lock
+from time import time
+from typing import BinaryIO, Callable, Iterable
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import uuid
+import zipfile
+
+from .importer import ImportStats, diff_import, parse_csv, parse_xml, run_import
+from .models import Contact, get_data_version
+from .render import iter_contacts_csv, iter_contacts_vcf, iter_contacts_xml
+from .utils import validate_contact_data
+
+BUNDLE_PREFIX = 'phonebook-'
+BUNDLE_SUFFIX = '.zip'
+# finished import jobs kept for their status page
+KEEP_IMPORT_JOBS = 100
+# job mode that only writes a diff report; see :func:`diff_import`
+DRY_RUN = 'dry-run'
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+STATUS_SUFFIX = '.job.json'
+
+
+def _write_status(path: Path, state: dict) -> None:
+    """Replace the status file at ``path`` atomically."""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.status-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+            json.dump(state, fh)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _read_status(directory: Path, job_id: str) -> dict | None:
+    """Return the state saved for ``job_id`` by any worker, or None."""
+    if not JOB_ID_RE.match(job_id):
+        return None
+    try:
+        with io.open(directory / f'{job_id}{STATUS_SUFFIX}', encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def bundle_entries(session_factory) -> list[tuple[str, Callable[[], Iterable[bytes]]]]:
+    """Return ``(path, render)`` pairs for every file of the bundle.
+
+    ``all/`` holds every active contact; each category found in the
+    database gets a directory of its own.
+    """
+    session = session_factory()
+    try:
+        categories = [
+            row[0] for row in
+            session.query(Contact.category).filter(Contact.active == True).distinct().order_by(Contact.category)  # noqa: E712
+        ]
+    finally:
+        session.close()
+    entries = []
+    for folder, category in [('all', None)] + [(c, c) for c in categories]:
+        entries += [
+            (f'{folder}/phonebook.xml', lambda c=category: iter_contacts_xml(session_factory, c)),
+            (f'{folder}/contacts.csv', lambda c=category: iter_contacts_csv(session_factory, c)),
+            (f'{folder}/contacts.vcf', lambda c=category: iter_contacts_vcf(session_factory, c)),
+        ]
+    return entries
+
+
+class ExportJob:
+    """State of one bundle build, updated by the worker thread."""
+
+    def __init__(self, version: int, path: Path) -> None:
+        self.id = uuid.uuid4().hex
+        self.version = version
+        self.path = path
+        self.status = 'queued'
+        self.entries_total = 0
+        self.entries_done = 0
+        self.bytes_written = 0
+        self.error: str | None = None
+        self.created = time()
+        self.finished: float | None = None
+        self.done = Event()
+
+    # attributes kept in the status file
+    STATE = ('id', 'version', 'status', 'entries_total', 'entries_done', 'bytes_written', 'error', 'created', 'finished')
+
+    def state(self) -> dict:
+        return {**{name: getattr(self, name) for name in self.STATE}, 'path': str(self.path)}
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'ExportJob':
+        job = cls(state['version'], Path(state['path']))
+        for name in cls.STATE:
+            setattr(job, name, state[name])
+        if job.finished is not None:
+            job.done.set()
+        return job
+
+    def to_dict(self) -> dict:
+        progress = self.entries_done / self.entries_total if self.entries_total else 0.0
+        data = {
+            'id': self.id,
+            'status': self.status,
+            'version': self.version,
+            'progress': round(1.0 if self.status == 'done' else progress, 3),
+            'entries_done': self.entries_done,
+            'entries_total': self.entries_total,
+            'bytes_written': self.bytes_written,
+        }
+        if self.status == 'done':
+            data['size'] = self.path.stat().st_size
+        if self.error:
+            data['error'] = self.error
+        return data
+
+
+class ExportJobs:
+    """Start, track and reuse bundle builds for the current data version.
+
+    Builds run on a small thread pool.  A request for a version that already
+    has a queued, running or finished job gets that job back; bundles of
+    older versions are removed once a newer one is finished.
+    """
+
+    def __init__(self, session_factory, directory: str | os.PathLike, workers: int = 1) -> None:
+        self._session_factory = session_factory
+        self._directory = Path(directory)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='phonebook-export')
+        self._lock = Lock()
+        self._jobs: dict[str, ExportJob] = {}
+
+    def _bundle_path(self, version: int) -> Path:
+        return self._directory / f'{BUNDLE_PREFIX}{version}{BUNDLE_SUFFIX}'
+
+    def get(self, job_id: str) -> ExportJob | None:
+        """Return the job, also when another worker process started it.
+
+        ``None`` once any worker pruned the job: its status file and bundle
+        are gone, so a copy still held here must not be served.
+        """
+        job = self._jobs.get(job_id)
+        if job is None or job.done.is_set():
+            # only a job running here is fresher than its status file
+            state = _read_status(self._directory, job_id)
+            job = ExportJob.from_state(state) if state else None
+            if job is None or (job.status == 'done' and not job.path.is_file()):
+                with self._lock:
+                    self._jobs.pop(job_id, None)
+                return None
+        return job
+
+    def _save(self, job: ExportJob) -> None:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        _write_status(self._directory / f'{job.id}{STATUS_SUFFIX}', job.state())
+
+    def start(self) -> tuple[ExportJob, bool]:
+        """Return the job for the current data version and whether it is new."""
+        session = self._session_factory()
+        try:
+            version, _ = get_data_version(session)
+        finally:
+            session.close()
+        path = self._bundle_path(version)
+        with self._lock:
+            for job in self._jobs.values():
+                if job.version == version and job.status != 'failed':
+                    return job, False
+            job = ExportJob(version, path)
+            self._jobs[job.id] = job
+            if path.is_file():
+                # built earlier, e.g. by another worker process
+                job.status = 'done'
+                job.finished = time()
+        if job.finished is not None:
+            # saved first: ``get`` drops finished jobs without a status file
+            self._save(job)
+            job.done.set()
+            return job, False
+        self._save(job)
+        self._executor.submit(self._build, job)
+        return job, True
+
+    def _build(self, job: ExportJob) -> None:
+        job.status = 'running'
+        tmp = None
+        try:
+            entries = bundle_entries(self._session_factory)
+            job.entries_total = len(entries)
+            self._directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self._directory, prefix='.bundle-', suffix=BUNDLE_SUFFIX)
+            with os.fdopen(fd, 'wb') as fh, zipfile.ZipFile(fh, 'w', zipfile.ZIP_DEFLATED) as bundle:
+                for name, render in entries:
+                    with bundle.open(name, 'w') as member:
+                        for chunk in render():
+                            member.write(chunk)
+                            job.bytes_written += len(chunk)
+                    job.entries_done += 1
+                    self._save(job)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, job.path)
+            tmp = None
+            job.status = 'done'
+        except Exception as exc:
+            job.status = 'failed'
+            job.error = str(exc)
+        finally:
+            job.finished = time()
+            if tmp is not None:
+                Path(tmp).unlink(missing_ok=True)
+        self._save(job)
+        if job.status == 'done':
+            self._prune(job.version)
+        job.done.set()
+
+    def _prune(self, version: int) -> None:
+        """Forget jobs and delete bundles of versions older than ``version``."""
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job.version < version and job.status in ('done', 'failed'):
+                    del self._jobs[job_id]
+        for path in self._directory.glob(f'*{STATUS_SUFFIX}'):
+            state = _read_status(self._directory, path.name[:-len(STATUS_SUFFIX)])
+            if state and state['version'] < version and state['finished'] is not None:
+                path.unlink(missing_ok=True)
+        for path in self._directory.glob(f'{BUNDLE_PREFIX}*{BUNDLE_SUFFIX}'):
+            stem = path.name[len(BUNDLE_PREFIX):-len(BUNDLE_SUFFIX)]
+            if stem.isdigit() and int(stem) < version:
+                path.unlink(missing_ok=True)
+
+    def wait(self, job: ExportJob, timeout: float | None = None) -> bool:
+        """Block until ``job`` has finished (used by tests)."""
+        return job.done.wait(timeout)
+
+
+def _valid_row(name: str | None, telephone: str | None) -> bool:
+    return validate_contact_data(name, telephone)[0]
+
+
+class ImportJob:
+    """An uploaded file spooled to disk and the progress of its import."""
+
+    def __init__(self, path: Path, filename: str, size: int, mode: str, category: str) -> None:
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.mode = mode
+        self.category = category
+        self.status = 'queued'
+        self.stats = ImportStats()
+        self.commit_batches: bool | None = None
+        # dry runs: the diff report and the data version it was computed at
+        self.report = path.with_name(path.name + '.diff.csv') if mode == DRY_RUN else None
+        self.version: int | None = None
+        self.applied_by: str | None = None
+        self.error: str | None = None
+        self.created = time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.done = Event()
+
+    # attributes kept in the status file
+    STATE = (
+        'id', 'filename', 'size', 'mode', 'category', 'status', 'commit_batches',
+        'version', 'applied_by', 'error', 'created', 'started', 'finished',
+    )
+
+    def state(self) -> dict:
+        return {
+            **{name: getattr(self, name) for name in self.STATE},
+            'path': str(self.path),
+            'stats': self.stats.to_dict(),
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'ImportJob':
+        job = cls(Path(state['path']), state['filename'], state['size'], state['mode'], state['category'])
+        for name in cls.STATE:
+            setattr(job, name, state[name])
+        for name, value in state['stats'].items():
+            setattr(job.stats, name, value)
+        if job.finished is not None:
+            job.done.set()
+        return job
+
+    def to_dict(self) -> dict:
+        processed = self.stats.accepted + self.stats.rejected
+        elapsed = (self.finished or time()) - self.started if self.started else 0.0
+        data = {
+            'id': self.id,
+            'status': self.status,
+            'filename': self.filename,
+            'size': self.size,
+            'mode': self.mode,
+            'processed': processed,
+            'rows_per_second': round(processed / elapsed) if elapsed > 0 else 0,
+            'elapsed_s': round(elapsed, 1),
+            **self.stats.to_dict(),
+        }
+        if self.mode == DRY_RUN:
+            data['version'] = self.version
+            data['applied_by'] = self.applied_by
+        if self.error:
+            data['error'] = self.error
+        return data
+
+
+class ImportJobs:
+    """Spool uploads to disk and import them on a small thread pool."""
+
+    def __init__(
+        self,
+        session_factory,
+        directory: str | os.PathLike,
+        workers: int = 1,
+        batch_size: int = 5000,
+        commit_batches: bool = False,
+    ) -> None:
+        self._session_factory = session_factory
+        self._directory = Path(directory)
+        self._batch_size = batch_size
+        self._commit_batches = commit_batches
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='phonebook-import')
+        self._lock = Lock()
+        self._jobs: dict[str, ImportJob] = {}
+
+    def get(self, job_id: str) -> ImportJob | None:
+        """Return the job, also when another worker process accepted it."""
+        job = self._jobs.get(job_id)
+        if job is None or job.done.is_set():
+            # only a job running here is fresher than its status file
+            state = _read_status(self._directory, job_id)
+            if state is None:
+                # pruned by some worker; a copy held here is stale
+                with self._lock:
+                    self._jobs.pop(job_id, None)
+                return None
+            job = ImportJob.from_state(state)
+        return job
+
+    def _status_path(self, job_id: str) -> Path:
+        return self._directory / f'{job_id}{STATUS_SUFFIX}'
+
+    def _save(self, job: ImportJob) -> None:
+        _write_status(self._status_path(job.id), job.state())
+
+    def _prune(self) -> None:
+        """Forget all but the newest ``KEEP_IMPORT_JOBS`` finished jobs of any worker."""
+        finished = []
+        for path in self._directory.glob(f'*{STATUS_SUFFIX}'):
+            state = _read_status(self._directory, path.name[:-len(STATUS_SUFFIX)])
+            if state and state['finished'] is not None:
+                finished.append(ImportJob.from_state(state))
+        for old in sorted(finished, key=lambda j: j.finished)[:-KEEP_IMPORT_JOBS]:
+            self._jobs.pop(old.id, None)
+            if old.report is not None:
+                old.path.unlink(missing_ok=True)
+                old.report.unlink(missing_ok=True)
+                old.path.with_name(old.path.name + '.applied').unlink(missing_ok=True)
+            self._status_path(old.id).unlink(missing_ok=True)
+
+    def spool(self, stream: BinaryIO, filename: str, mode: str = 'insert', category: str = 'other') -> ImportJob:
+        """Copy the upload ``stream`` to disk and register a queued job."""
+        self._directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self._directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                shutil.copyfileobj(stream, fh, 1024 * 1024)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        path = Path(tmp)
+        job = ImportJob(path, filename, path.stat().st_size, mode, category)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._save(job)
+        return job
+
+    def submit(self, job: ImportJob) -> None:
+        self._executor.submit(self.run, job)
+
+    def run(self, job: ImportJob) -> None:
+        """Import the spooled file of ``job`` in the calling thread.
+
+        Dry runs keep the spooled file so the diff can be applied later.
+        """
+        job.status = 'running'
+        job.started = time()
+        self._save(job)
+        try:
+            with io.open(job.path, encoding='utf-8', newline='') as fh:
+                rows = parse_xml(fh) if job.filename.lower().endswith('.xml') else parse_csv(fh)
+                if job.mode == DRY_RUN:
+                    with io.open(job.report, 'w', encoding='utf-8', newline='') as report:
+                        _, job.version = diff_import(
+                            rows, _valid_row, report, session_factory=self._session_factory, stats=job.stats,
+                        )
+                else:
+                    run_import(
+                        rows,
+                        _valid_row,
+                        job.category,
+                        batch_size=self._batch_size,
+                        commit_batches=self._commit_batches if job.commit_batches is None else job.commit_batches,
+                        session_factory=self._session_factory,
+                        mode=job.mode,
+                        stats=job.stats,
+                        progress=lambda stats: self._save(job),
+                    )
+            job.status = 'done'
+        except Exception as exc:
+            job.status = 'failed'
+            job.error = str(exc)
+        finally:
+            job.finished = time()
+            if job.mode != DRY_RUN:
+                job.path.unlink(missing_ok=True)
+            self._save(job)
+            job.done.set()
+
+    def apply(self, dry_run: ImportJob) -> ImportJob:
+        """Queue the upsert a finished dry run described, in one transaction.
+
+        Raises ``ValueError`` when the dry run is not finished, was already
+        applied or the data changed since, as the diff would then no longer
+        match what gets written.
+        """
+        if dry_run.mode != DRY_RUN or dry_run.status != 'done':
+            raise ValueError('Alleen een afgeronde proefimport kan worden toegepast.')
+        claim = dry_run.path.with_name(dry_run.path.name + '.applied')
+        if dry_run.applied_by is not None or claim.exists():
+            raise ValueError('Deze proefimport is al toegepast.')
+        session = self._session_factory()
+        try:
+            version, _ = get_data_version(session)
+        finally:
+            session.close()
+        if version != dry_run.version:
+            raise ValueError('De gegevens zijn gewijzigd sinds de proefimport; voer die opnieuw uit.')
+        try:
+            # claimed with an exclusive create, so only one worker process applies it
+            os.close(os.open(claim, os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            raise ValueError('Deze proefimport is al toegepast.') from None
+        job = ImportJob(dry_run.path, dry_run.filename, dry_run.size, 'upsert', dry_run.category)
+        job.commit_batches = False
+        dry_run.applied_by = job.id
+        with self._lock:
+            self._jobs[job.id] = job
+        self._save(job)
+        self._save(dry_run)
+        return job
+
+    def wait(self, job: ImportJob, timeout: float | None = None) -> bool:
+        """Block until ``job`` has finished (used by tests)."""
+        return job.done.wait(timeout)
@@ -1,19 +1,46 @@
 from flask import current_app
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
-from sqlalchemy.orm import declarative_base, relationship
-import csv
-import xml.etree.ElementTree as ET
+from sqlalchemy import (
+    DDL, Column, Integer, String, Boolean, DateTime, ForeignKey, Index, event, func, select, text, update,
+)
+from sqlalchemy.orm import Session, declarative_base, relationship
+from datetime import datetime, timezone
+
+from .utils import MAX_SQL_INT, number_digits
 
 Base = declarative_base()
 
+# Partial-index predicate for rows the read paths see; each dialect spells
+# it the way SQLAlchemy renders ``Contact.active == True`` so the planner
+# can match the two.
+ACTIVE_ONLY = {'sqlite_where': text('active = 1'), 'postgresql_where': text('active')}
+
 
 class Contact(Base):
     __tablename__ = 'contacts'
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     telephone = Column(String, nullable=False)
+    # ``number_digits(telephone)``, kept in sync on assignment for caller-ID lookups
+    telephone_digits = Column(String, index=True)
     category = Column(String, nullable=False, default='other')
     active = Column(Boolean, nullable=False, default=True)
+    # data version of the last write to this row (see ``mark_changed``)
+    change_seq = Column(Integer, nullable=False, default=0, index=True)
+
+    __table_args__ = (
+        # active contacts by name (and id, the keyset tie-breaker), per category or not
+        Index('ix_contacts_active_name', 'name', 'id', **ACTIVE_ONLY),
+        Index('ix_contacts_active_category_name', 'category', 'name', 'id', **ACTIVE_ONLY),
+    )
+
+
+# The A-Z slices compare names byte by byte.  SQLite's default collation
+# already does and seeks ix_contacts_active_name; PostgreSQL needs an index
+# in the "C" collation the slice queries ask for.
+CONTACTS_BYTE_ORDER_INDEX = (
+    'CREATE INDEX ix_contacts_active_name_c ON contacts (name COLLATE "C", id) WHERE active'
+)
+event.listen(Contact.__table__, 'after_create', DDL(CONTACTS_BYTE_ORDER_INDEX).execute_if(dialect='postgresql'))
 
 
 # ---------------------------------------------------------------------------
@@ -44,6 +71,9 @@ class Practice(Base):
     name = Column(String, nullable=False)
     email = Column(String)
     address_id = Column(Integer, ForeignKey('addresses.id'))
+    change_seq = Column(Integer, nullable=False, default=0, index=True)
+
+    __table_args__ = (Index('ix_practices_name', 'name', 'id'),)
 
     address = relationship('Address')
     phone_numbers = relationship('PhoneNumber', back_populates='practice')
@@ -59,6 +89,9 @@ class Supplier(Base):
     name = Column(String, nullable=False)
     email = Column(String)
     address_id = Column(Integer, ForeignKey('addresses.id'))
+    change_seq = Column(Integer, nullable=False, default=0, index=True)
+
+    __table_args__ = (Index('ix_suppliers_name', 'name', 'id'),)
 
     address = relationship('Address')
     phone_numbers = relationship('PhoneNumber', back_populates='supplier')
@@ -75,6 +108,9 @@ class ContactPerson(Base):
     last_name = Column(String, nullable=False)
     email = Column(String)
     function = Column(String)
+    change_seq = Column(Integer, nullable=False, default=0, index=True)
+
+    __table_args__ = (Index('ix_contact_persons_last_name', 'last_name', 'id'),)
 
     phone_numbers = relationship('PhoneNumber', back_populates='contact_person')
     practice_links = relationship('PracticeContact', back_populates='contact', cascade='all, delete-orphan')
@@ -89,10 +125,12 @@ class PhoneNumber(Base):
     __tablename__ = 'phone_numbers'
     id = Column(Integer, primary_key=True)
     number = Column(String, nullable=False)
+    number_digits = Column(String, index=True)
     type = Column(String)
-    practice_id = Column(Integer, ForeignKey('practices.id'))
-    supplier_id = Column(Integer, ForeignKey('suppliers.id'))
-    contact_person_id = Column(Integer, ForeignKey('contact_persons.id'))
+    practice_id = Column(Integer, ForeignKey('practices.id'), index=True)
+    supplier_id = Column(Integer, ForeignKey('suppliers.id'), index=True)
+    contact_person_id = Column(Integer, ForeignKey('contact_persons.id'), index=True)
+    change_seq = Column(Integer, nullable=False, default=0, index=True)
 
     practice = relationship('Practice', back_populates='phone_numbers')
     supplier = relationship('Supplier', back_populates='phone_numbers')
@@ -104,7 +142,7 @@ class PracticeContact(Base):
 
     __tablename__ = 'practice_contacts'
     practice_id = Column(Integer, ForeignKey('practices.id'), primary_key=True)
-    contact_id = Column(Integer, ForeignKey('contact_persons.id'), primary_key=True)
+    contact_id = Column(Integer, ForeignKey('contact_persons.id'), primary_key=True, index=True)
     role = Column(String)
     is_primary = Column(Boolean, nullable=False, default=False)
 
@@ -117,7 +155,7 @@ class SupplierContact(Base):
 
     __tablename__ = 'supplier_contacts'
     supplier_id = Column(Integer, ForeignKey('suppliers.id'), primary_key=True)
-    contact_id = Column(Integer, ForeignKey('contact_persons.id'), primary_key=True)
+    contact_id = Column(Integer, ForeignKey('contact_persons.id'), primary_key=True, index=True)
     role = Column(String)
     is_primary = Column(Boolean, nullable=False, default=False)
 
@@ -125,21 +163,140 @@ class SupplierContact(Base):
     contact = relationship('ContactPerson', back_populates='supplier_links')
 
 
+@event.listens_for(Contact.telephone, 'set')
+def _set_telephone_digits(target, value, oldvalue, initiator):
+    target.telephone_digits = number_digits(value)
+
+
+@event.listens_for(PhoneNumber.number, 'set')
+def _set_number_digits(target, value, oldvalue, initiator):
+    target.number_digits = number_digits(value)
+
+
+class DataVersion(Base):
+    """Single-row change sequence bumped by every phonebook write.
+
+    HTTP validators (ETag/Last-Modified) and the render cache are derived from
+    this row so a conditional request only needs one tiny lookup.
+    """
+
+    __tablename__ = 'data_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
+    # version of the last hard delete of a practice, supplier or person;
+    # change feeds from before it cannot express the removal
+    deleted_seq = Column(Integer, nullable=False, default=0)
+
+
 def _get_session():
     """Return a new SQLAlchemy session using the app's session factory."""
     Session = current_app.config['SESSION_FACTORY']
     return Session()
 
 
-def load_phonebook():
-    """Return all active contacts ordered by name as a list of dicts."""
-    session = _get_session()
-    contacts = (
+def _utcnow():
+    # HTTP dates have second resolution; store what Last-Modified can express
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+
+def ensure_data_version(session):
+    """Create the ``data_version`` row if it does not exist yet."""
+    if session.get(DataVersion, 1) is None:
+        session.add(DataVersion(id=1, version=0, updated_at=_utcnow()))
+        session.commit()
+
+
+def mark_changed(session):
+    """Bump the persisted change sequence inside ``session``'s transaction.
+
+    Call before committing a write so the new version becomes visible
+    atomically with the data it describes.  The version is bumped once per
+    transaction and returned; rows of the tracked models flushed in the
+    same transaction are stamped with it in ``change_seq``.  The session is
+    also flagged so after-commit hooks (e.g. the publisher) know the data
+    changed.
+    """
+    session.info['phonebook_changed'] = True
+    seq = session.info.get('change_seq')
+    if seq is not None:
+        return seq
+    # the connection bypasses autoflush, so pending rows are stamped below
+    connection = session.connection()
+    result = connection.execute(
+        update(DataVersion)
+        .where(DataVersion.id == 1)
+        .values(version=DataVersion.version + 1, updated_at=_utcnow())
+    )
+    if result.rowcount == 0:
+        connection.execute(DataVersion.__table__.insert().values(id=1, version=1, updated_at=_utcnow()))
+    seq = connection.execute(select(DataVersion.version).where(DataVersion.id == 1)).scalar_one()
+    session.info['change_seq'] = seq
+    return seq
+
+
+# Rows stamped with ``change_seq`` so ``?since=`` can return only changes.
+TRACKED_MODELS = (Contact, Practice, Supplier, ContactPerson, PhoneNumber)
+# Deleted outright rather than flagged inactive, so no row is left to stamp.
+HARD_DELETED_MODELS = (Practice, Supplier, ContactPerson)
+
+
+@event.listens_for(Session, 'before_flush')
+def _stamp_changes(session, flush_context, instances):
+    changed = [obj for obj in session.new if isinstance(obj, TRACKED_MODELS)]
+    changed += [
+        obj for obj in session.dirty
+        if isinstance(obj, TRACKED_MODELS) and session.is_modified(obj, include_collections=False)
+    ]
+    # a new or removed link changes the person's organizations
+    links = [obj for obj in (*session.new, *session.deleted) if isinstance(obj, (PracticeContact, SupplierContact))]
+    changed += [link.contact for link in links if link.contact is not None and link.contact not in session.deleted]
+    if not changed and not links and not any(isinstance(obj, TRACKED_MODELS) for obj in session.deleted):
+        return
+    seq = mark_changed(session)
+    for obj in changed:
+        obj.change_seq = seq
+    if any(isinstance(obj, HARD_DELETED_MODELS) for obj in session.deleted):
+        session.connection().execute(update(DataVersion).where(DataVersion.id == 1).values(deleted_seq=seq))
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _reset_change_seq(session):
+    session.info.pop('change_seq', None)
+
+
+def get_data_version(session):
+    """Return ``(version, updated_at)`` of the persisted change sequence.
+
+    ``updated_at`` is a timezone-aware UTC datetime.
+    """
+    row = session.execute(
+        select(DataVersion.version, DataVersion.updated_at).where(DataVersion.id == 1)
+    ).first()
+    if row is None:
+        return 0, datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return row.version, row.updated_at.replace(tzinfo=timezone.utc)
+
+
+def _active_by_position(session):
+    """Active contacts in the order their sorted-position index refers to."""
+    return (
         session.query(Contact)
         .filter(Contact.active == True)  # noqa: E712
-        .order_by(Contact.name)
-        .all()
+        .order_by(Contact.name, Contact.id)
     )
+
+
+def get_deleted_seq(session):
+    """Return the data version of the last hard delete (0 if none)."""
+    return session.execute(select(DataVersion.deleted_seq).where(DataVersion.id == 1)).scalar() or 0
+
+
+def load_phonebook():
+    """Return all active contacts ordered by name as a list of dicts."""
+    session = _get_session()
+    contacts = _active_by_position(session).all()
     result = [
         {
             'id': c.id,
@@ -153,23 +310,50 @@ def load_phonebook():
     return result
 
 
+def _at_position(session, index):
+    if not 0 <= index <= MAX_SQL_INT:
+        return None
+    return _active_by_position(session).offset(index).limit(1).first()
+
+
+def _by_id(session, contact_id):
+    if not 0 <= contact_id <= MAX_SQL_INT:
+        return None
+    return session.query(Contact).filter(Contact.id == contact_id, Contact.active == True).first()  # noqa: E712
+
+
+def _as_dict(contact):
+    return {'id': contact.id, 'name': contact.name, 'telephone': contact.telephone, 'category': contact.category}
+
+
+def get_contact(index):
+    """Return the active contact at sorted position ``index`` as a dict, or None."""
+    session = _get_session()
+    c = _at_position(session, index)
+    session.close()
+    return None if c is None else _as_dict(c)
+
+
+def get_contact_by_id(contact_id):
+    """Return the active contact with primary key ``contact_id`` as a dict, or None."""
+    session = _get_session()
+    c = _by_id(session, contact_id)
+    session.close()
+    return None if c is None else _as_dict(c)
+
+
 def add_contact(name, telephone, category='other'):
     session = _get_session()
     session.add(Contact(name=name, telephone=telephone, category=category))
+    mark_changed(session)
     session.commit()
     session.close()
 
 
-def delete_contact(index):
-    session = _get_session()
-    contacts = (
-        session.query(Contact)
-        .filter(Contact.active == True)  # noqa: E712
-        .order_by(Contact.name)
-        .all()
-    )
-    if 0 <= index < len(contacts):
-        contacts[index].active = False
+def _deactivate(session, contact):
+    if contact is not None:
+        contact.active = False
+        mark_changed(session)
         session.commit()
         session.close()
         return True
@@ -177,19 +361,22 @@ def delete_contact(index):
     return False
 
 
-def update_contact(index, name, telephone, category='other'):
+def delete_contact(index):
     session = _get_session()
-    contacts = (
-        session.query(Contact)
-        .filter(Contact.active == True)  # noqa: E712
-        .order_by(Contact.name)
-        .all()
-    )
-    if 0 <= index < len(contacts):
-        contact = contacts[index]
+    return _deactivate(session, _at_position(session, index))
+
+
+def delete_contact_by_id(contact_id):
+    session = _get_session()
+    return _deactivate(session, _by_id(session, contact_id))
+
+
+def _update(session, contact, name, telephone, category):
+    if contact is not None:
         contact.name = name
         contact.telephone = telephone
         contact.category = category
+        mark_changed(session)
         session.commit()
         session.close()
         return True
@@ -197,59 +384,11 @@ def update_contact(index, name, telephone, category='other'):
     return False
 
 
-def import_contacts(fileobj, validator, category='other'):
+def update_contact(index, name, telephone, category='other'):
     session = _get_session()
-    reader = csv.DictReader(fileobj)
-    added = 0
-    for row in reader:
-        name = row.get('name') or row.get('Name')
-        telephone = row.get('telephone') or row.get('Telephone')
-        if validator(name, telephone):
-            session.add(Contact(name=name, telephone=telephone, category=category))
-            added += 1
-    if added:
-        session.commit()
-    else:
-        session.rollback()
-    session.close()
-    return added
+    return _update(session, _at_position(session, index), name, telephone, category)
 
 
-def import_contacts_xml(fileobj, validator, category="other"):
-    """Import contacts from Yealink XML files.
-
-    Supports the current ``YealinkIPPhoneDirectory`` export format as well as
-    the legacy ``YealinkIPPhoneBook`` structure previously used in this
-    project.  Other XML structures are ignored.
-    """
-
+def update_contact_by_id(contact_id, name, telephone, category='other'):
     session = _get_session()
-    tree = ET.parse(fileobj)
-    root = tree.getroot()
-
-    added = 0
-
-    # Modern format: <YealinkIPPhoneDirectory><DirectoryEntry>...</DirectoryEntry></YealinkIPPhoneDirectory>
-    entries = root.findall("DirectoryEntry")
-    if entries:
-        for entry in entries:
-            name = entry.findtext("Name")
-            telephone = entry.findtext("Telephone")
-            if validator(name, telephone):
-                session.add(Contact(name=name, telephone=telephone, category=category))
-                added += 1
-    else:
-        # Legacy format: <YealinkIPPhoneBook><Directory><Unit Name=".." Phone1=".."/></Directory></YealinkIPPhoneBook>
-        for unit in root.findall("./Directory/Unit"):
-            name = unit.attrib.get("Name")
-            telephone = unit.attrib.get("Phone1")
-            if validator(name, telephone):
-                session.add(Contact(name=name, telephone=telephone, category=category))
-                added += 1
-
-    if added:
-        session.commit()
-    else:
-        session.rollback()
-    session.close()
-    return added
+    return _update(session, _by_id(session, contact_id), name, telephone, category)
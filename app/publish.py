@@ -0,0 +1,117 @@
+"""Publish the phonebook artifacts as static files.
+
+With ``PUBLISH_DIR`` configured, every committed write regenerates
+``root.xml``, the directory XML files, ``contacts.csv`` and ``contacts.vcf``
+(plus ``.gz`` siblings for ``gzip_static``) so a front-end web server can
+serve phone polls without reaching Python.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from pathlib import Path
+import gzip
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+from .cache import GZIP_LEVEL, BackgroundRefresh
+from .models import get_data_version
+from .render import published_artifacts
+
+VERSION_FILE = '.version'
+LOCK_FILE = '.publish.lock'
+
+
+def _published_version(directory: Path) -> int:
+    try:
+        return int((directory / VERSION_FILE).read_text())
+    except (OSError, ValueError):
+        return -1
+
+
+@contextmanager
+def _directory_lock(directory: Path):
+    """Serialize publishers from several worker processes."""
+    with open(directory / LOCK_FILE, 'w') as fh:
+        if fcntl is not None:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _write_temp(target: Path, data: bytes) -> Path:
+    """Write ``data`` to a temp file next to ``target`` and return its path."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f'.{target.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        # mkstemp creates 0600 files; the web server must be able to read them
+        os.chmod(tmp, 0o644)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return Path(tmp)
+
+
+def publish(app, force: bool = False) -> int | None:
+    """Render all artifacts and atomically move them into ``PUBLISH_DIR``.
+
+    Files are written to temp files and renamed into place.  Returns the
+    data version that was published, or ``None`` when the directory was
+    already up to date (unless ``force`` is set).
+    """
+    directory = Path(app.config['PUBLISH_DIR'])
+    directory.mkdir(parents=True, exist_ok=True)
+    session_factory = app.config['SESSION_FACTORY']
+    session = session_factory()
+    try:
+        version, _ = get_data_version(session)
+    finally:
+        session.close()
+    if not force and _published_version(directory) >= version:
+        return None
+
+    staged: list[tuple[Path, Path]] = []
+    try:
+        # root.xml builds its links with url_for
+        with app.test_request_context():
+            for name, data in published_artifacts(session_factory).items():
+                target = directory / name
+                staged.append((_write_temp(target, data), target))
+                gz_target = target.with_name(target.name + '.gz')
+                staged.append((_write_temp(gz_target, gzip.compress(data, GZIP_LEVEL, mtime=0)), gz_target))
+        with _directory_lock(directory):
+            # another worker may have published a newer version meanwhile
+            if not force and _published_version(directory) >= version:
+                return None
+            for tmp, target in staged:
+                os.replace(tmp, target)
+            staged = []
+            os.replace(_write_temp(directory / VERSION_FILE, str(version).encode()), directory / VERSION_FILE)
+        return version
+    finally:
+        for tmp, _ in staged:
+            tmp.unlink(missing_ok=True)
+
+
+class Publisher(BackgroundRefresh):
+    """Run :func:`publish` in a background thread after each write.
+
+    Requests are coalesced: any number of writes arriving while a run is in
+    progress trigger exactly one more run, so bursts of edits do not queue
+    up full regenerations.
+    """
+
+    def __init__(self, app) -> None:
+        super().__init__(lambda: publish(app), 'phonebook-publisher', app.logger)
@@ -0,0 +1,517 @@
+"""Renderers for the phonebook artifacts (Yealink XML, CSV and VCF).
+
+Each renderer yields ``bytes`` chunks and opens its own session from the
+given session factory, so it can run inside a request, in a streamed response
+after the view returned, or from the publisher.
+"""
+
+from __future__ import annotations
+
+from itertools import chain
+from typing import Callable, Iterator
+import csv
+import io
+
+from flask import current_app, url_for
+from sqlalchemy import and_, func, or_, select, union
+from sqlalchemy.orm import selectinload
+from xml.sax.saxutils import escape
+
+from .models import Contact, ContactPerson, PhoneNumber, Practice, Supplier
+
+# Matches what ``ET.tostring(..., xml_declaration=True)`` emits so streamed and
+# tree-built documents are byte-identical.
+XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+STREAM_BATCH_SIZE = 500
+# Letter groups of the A-Z index, following the handset keypad.
+ALPHA_RANGES = ('A-C', 'D-F', 'G-I', 'J-L', 'M-O', 'P-S', 'T-V', 'W-Z')
+
+
+def menu_item(name: str, url: str) -> str:
+    return f'<MenuItem><Name>{escape(name)}</Name><URL>{escape(url)}</URL></MenuItem>'
+
+
+def directory_entry(name: str, telephone: str) -> str:
+    # ``escape`` handles &, < and > exactly like ElementTree does for text
+    return (
+        f'<DirectoryEntry><Name>{escape(name)}</Name>'
+        f'<Telephone>{escape(telephone)}</Telephone></DirectoryEntry>'
+    )
+
+
+def stream_directory(items: Iterator[str]) -> Iterator[bytes]:
+    """Wrap serialized ``items`` in a ``YealinkIPPhoneDirectory`` document."""
+    first = next(items, None)
+    if first is None:
+        yield XML_DECLARATION + b'<YealinkIPPhoneDirectory />'
+        return
+    chunk = [XML_DECLARATION.decode(), '<YealinkIPPhoneDirectory>', first]
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= STREAM_BATCH_SIZE:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+    chunk.append('</YealinkIPPhoneDirectory>')
+    yield ''.join(chunk).encode('utf-8')
+
+
+def _paged(items: Iterator[str], page: int, page_size: int, page_url: Callable[[int], str]) -> Iterator[str]:
+    """Yield at most ``page_size`` items followed by Previous/Next links.
+
+    ``items`` must hold one row more than a page so the last page can be
+    detected without a separate COUNT query.
+    """
+    count = 0
+    for item in items:
+        count += 1
+        if count > page_size:
+            break
+        yield item
+    if page > 1:
+        yield menu_item('Previous', page_url(page - 1))
+    if count > page_size:
+        yield menu_item('Next', page_url(page + 1))
+
+
+def _letter_ranges(first: str, last: str, dialect: str):
+    """Range conditions for names starting with ``first``..``last``.
+
+    One per case, so each is a seek on ``ix_contacts_active_name``; OR-ing
+    them would make the planner walk the whole index instead.  The ranges
+    compare bytes like the routing in :func:`iter_contact_artifacts`: a
+    locale collation, as PostgreSQL's default usually is, interleaves the
+    cases and ignores punctuation, so there names are compared ``COLLATE
+    "C"`` and sought on ``ix_contacts_active_name_c``.
+    """
+    name = Contact.name.collate('C') if dialect == 'postgresql' else Contact.name
+    return (
+        and_(name >= first, name < chr(ord(last) + 1)),
+        and_(name >= first.lower(), name < chr(ord(last.lower()) + 1)),
+    )
+
+
+def iter_contacts_xml(
+    session_factory,
+    category: str | None = None,
+    letters: tuple[str, str] | None = None,
+    page: int = 1,
+    page_size: int = 0,
+    page_url: Callable[[int], str] | None = None,
+) -> Iterator[bytes]:
+    """Yield a Yealink directory document in chunks straight from the DB.
+
+    Rows are fetched in batches of ``STREAM_BATCH_SIZE`` (a server-side
+    cursor where the driver supports it), so no ORM objects or element tree
+    for the whole directory are ever held in memory.  With a ``page_size``
+    only that slice is fetched and Previous/Next menu items are appended.
+    """
+    session = session_factory()
+    try:
+        query = session.query(Contact.name, Contact.telephone, Contact.id).filter(Contact.active == True)  # noqa: E712
+        if category:
+            query = query.filter(Contact.category == category)
+        if letters:
+            upper, lower = _letter_ranges(*letters, session.get_bind().dialect.name)
+            # upper-case initials sort before lower-case ones
+            query = query.filter(upper).union_all(query.filter(lower))
+        query = query.order_by(Contact.name, Contact.id)
+        if page_size:
+            query = query.offset((page - 1) * page_size).limit(page_size + 1)
+        rows = query.yield_per(STREAM_BATCH_SIZE)
+        items = (directory_entry(name, telephone) for name, telephone, _ in rows)
+        if page_size:
+            items = _paged(items, page, page_size, page_url)
+        yield from stream_directory(items)
+    finally:
+        session.close()
+
+
+def root_menu() -> bytes:
+    """Top-level menu; needs a request context for ``url_for``."""
+    items = [
+        ('All', url_for('xml.all_xml', _external=False)),
+        ('Practices', url_for('xml.practices_xml', _external=False)),
+        ('Suppliers', url_for('xml.suppliers_xml', _external=False)),
+    ]
+    if current_app.config['PHONEBOOK_ALPHA_INDEX']:
+        items.append(('A-Z', url_for('xml.index_xml', _external=False)))
+    return b''.join(stream_directory(menu_item(name, url) for name, url in items))
+
+
+def index_menu() -> bytes:
+    """A-Z submenu; needs a request context for ``url_for``."""
+    return b''.join(stream_directory(
+        menu_item(letters, url_for('xml.letters_xml', letters=letters, _external=False))
+        for letters in ALPHA_RANGES
+    ))
+
+
+CSV_COLUMNS = ('name', 'telephone', 'category')
+
+
+class CsvLines:
+    """Format rows with :mod:`csv` quoting through one reused buffer.
+
+    Names with commas, quotes or line breaks come out quoted instead of
+    shifting the columns; plain rows stay ``name,telephone,category``.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+
+    def __call__(self, *fields: str) -> str:
+        self._writer.writerow(fields)
+        line = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return line
+
+
+def vcard(name: str, telephone: str) -> str:
+    parts = name.split(' ', 1)
+    first = parts[0]
+    last = parts[1] if len(parts) > 1 else ''
+    return (
+        'BEGIN:VCARD\n'
+        'VERSION:3.0\n'
+        f'N:{last};{first}\n'
+        f'FN:{name}\n'
+        f'TEL;TYPE=CELL:{telephone}\n'
+        'END:VCARD\n'
+    )
+
+
+# ``category`` filter values of :func:`iter_vcards`.
+VCARD_CATEGORIES = ('practice', 'supplier', 'person')
+# Free-text ``PhoneNumber.type`` values mapped to vCard TEL types.
+TEL_TYPES = {'mobile': 'CELL', 'cell': 'CELL', 'fax': 'FAX', 'home': 'HOME', 'work': 'WORK'}
+
+
+def _vcard_text(value: str) -> str:
+    """Escape a vCard text value (RFC 2426 section 4)."""
+    return (
+        value.replace('\\', '\\\\').replace(',', '\\,').replace(';', '\\;')
+        .replace('\r\n', '\\n').replace('\n', '\\n')
+    )
+
+
+def rich_vcard(
+    name: str,
+    n: tuple[str, str],
+    category: str,
+    org: str | None = None,
+    title: str | None = None,
+    email: str | None = None,
+    phones=(),
+    address=None,
+) -> str:
+    """One vCard with every number, the email and the postal address.
+
+    ``n`` is ``(last, first)``; ``phones`` are :class:`PhoneNumber` rows and
+    ``address`` an :class:`Address`.
+    """
+    lines = [
+        'BEGIN:VCARD',
+        'VERSION:3.0',
+        f'N:{_vcard_text(n[0])};{_vcard_text(n[1])};;;',
+        f'FN:{_vcard_text(name)}',
+    ]
+    if org:
+        lines.append(f'ORG:{_vcard_text(org)}')
+    if title:
+        lines.append(f'TITLE:{_vcard_text(title)}')
+    if email:
+        lines.append(f'EMAIL;TYPE=INTERNET:{_vcard_text(email)}')
+    for phone in phones:
+        tel_type = TEL_TYPES.get((phone.type or '').strip().lower(), 'VOICE')
+        lines.append(f'TEL;TYPE={tel_type}:{_vcard_text(phone.number)}')
+    if address is not None:
+        street = ' '.join(part for part in (address.street, address.number) if part)
+        fields = ('', '', street, address.city or '', '', address.postal_code or '', address.country or '')
+        if any(fields):
+            lines.append('ADR;TYPE=WORK:' + ';'.join(_vcard_text(f) for f in fields))
+    lines += [f'CATEGORIES:{category}', 'END:VCARD']
+    return '\n'.join(lines) + '\n'
+
+
+def _changed_since(model, since: int):
+    """Rows written after ``since`` themselves or through a phone number.
+
+    Both halves are range seeks on a ``change_seq`` index whose ids are
+    then looked up by primary key; an ``OR`` of the two would make the
+    planner walk the whole table in name order instead.
+    """
+    [(local, remote)] = model.phone_numbers.property.local_remote_pairs
+    return local.in_(union(
+        select(local).where(model.change_seq > since),
+        select(remote).where(PhoneNumber.change_seq > since),
+    ))
+
+
+def _vcard_pieces(
+    session,
+    category: str | None,
+    organization: str | None,
+    since: int | None = None,
+) -> Iterator[str]:
+    for model, kind in ((Practice, 'practice'), (Supplier, 'supplier')):
+        if category not in (None, kind):
+            continue
+        query = (
+            session.query(model)
+            .options(selectinload(model.address), selectinload(model.phone_numbers))
+            .order_by(model.name, model.id)
+        )
+        if organization:
+            query = query.filter(func.lower(model.name) == organization)
+        if since is not None:
+            query = query.filter(_changed_since(model, since))
+        for org in query.yield_per(STREAM_BATCH_SIZE):
+            yield rich_vcard(org.name, (org.name, ''), kind, org=org.name, email=org.email,
+                             phones=org.phone_numbers, address=org.address)
+
+    if category not in (None, 'person'):
+        return
+    query = (
+        session.query(ContactPerson)
+        .options(
+            selectinload(ContactPerson.phone_numbers),
+            selectinload(ContactPerson.practices),
+            selectinload(ContactPerson.suppliers),
+        )
+        .order_by(ContactPerson.last_name, ContactPerson.first_name, ContactPerson.id)
+    )
+    if organization:
+        query = query.filter(or_(
+            ContactPerson.practices.any(func.lower(Practice.name) == organization),
+            ContactPerson.suppliers.any(func.lower(Supplier.name) == organization),
+        ))
+    if since is not None:
+        query = query.filter(_changed_since(ContactPerson, since))
+    for person in query.yield_per(STREAM_BATCH_SIZE):
+        orgs = [org.name for org in (*person.practices, *person.suppliers)]
+        if organization:
+            orgs = [name for name in orgs if name.lower() == organization] or orgs
+        yield rich_vcard(
+            f'{person.first_name} {person.last_name}',
+            (person.last_name, person.first_name),
+            'person',
+            org=orgs[0] if orgs else None,
+            title=person.function,
+            email=person.email,
+            phones=person.phone_numbers,
+        )
+
+
+def iter_vcards(
+    session_factory,
+    category: str | None = None,
+    organization: str | None = None,
+    since: int | None = None,
+) -> Iterator[bytes]:
+    """Stream vCards for practices, suppliers and their contact persons.
+
+    Rows are read in batches of ``STREAM_BATCH_SIZE``; numbers, addresses
+    and organizations are loaded per batch with ``selectinload``, so the
+    query count grows with the number of batches rather than with the
+    number of entities.  ``category`` is one of ``VCARD_CATEGORIES``;
+    ``organization`` (lower-cased) limits the export to the practice or
+    supplier of that name and the persons linked to it.  With ``since`` only
+    entities changed after that data version (including their numbers and
+    organization links) are exported.
+    """
+    session = session_factory()
+    try:
+        yield from _encode_batches(_vcard_pieces(session, category, organization, since))
+    finally:
+        session.close()
+
+
+def _encode_batches(pieces: Iterator[str]) -> Iterator[bytes]:
+    chunk = []
+    for piece in pieces:
+        chunk.append(piece)
+        if len(chunk) >= STREAM_BATCH_SIZE:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode('utf-8')
+
+
+def _active_rows(session_factory, category: str | None) -> Iterator[tuple[str, str, str]]:
+    session = session_factory()
+    try:
+        query = (
+            session.query(Contact.name, Contact.telephone, Contact.category)
+            .filter(Contact.active == True)  # noqa: E712
+        )
+        if category:
+            query = query.filter(Contact.category == category)
+        yield from query.order_by(Contact.name, Contact.id).yield_per(STREAM_BATCH_SIZE)
+    finally:
+        session.close()
+
+
+def iter_contacts_csv(session_factory, category: str | None = None) -> Iterator[bytes]:
+    """``contacts.csv`` limited to one category; see :func:`iter_contact_artifacts`."""
+    csv_line = CsvLines()
+    lines = (csv_line(*row) for row in _active_rows(session_factory, category))
+    yield from _encode_batches(chain([csv_line(*CSV_COLUMNS)], lines))
+
+
+def iter_contacts_vcf(session_factory, category: str | None = None) -> Iterator[bytes]:
+    """``contacts.vcf`` limited to one category."""
+    rows = _active_rows(session_factory, category)
+    yield from _encode_batches(vcard(name, telephone) for name, telephone, _ in rows)
+
+
+CHANGES_CSV_COLUMNS = ('id', 'name', 'telephone', 'category', 'active', 'change_seq')
+
+
+def iter_contact_changes_csv(session_factory, since: int) -> Iterator[bytes]:
+    """Stream contacts created, updated or soft-deleted after ``since`` as CSV.
+
+    Unlike ``contacts.csv`` the rows carry their ``id``, and deleted contacts
+    are included with ``active`` set to ``0`` so a sync can drop them.
+    """
+    csv_line = CsvLines()
+    session = session_factory()
+    try:
+        rows = (
+            session.query(Contact.id, Contact.name, Contact.telephone, Contact.category,
+                          Contact.active, Contact.change_seq)
+            .filter(Contact.change_seq > since)
+            .order_by(Contact.change_seq, Contact.id)
+            .yield_per(STREAM_BATCH_SIZE)
+        )
+        lines = (
+            csv_line(str(id_), name, telephone, category, str(int(active)), str(seq))
+            for id_, name, telephone, category, active, seq in rows
+        )
+        yield from _encode_batches(chain([csv_line(*CHANGES_CSV_COLUMNS)], lines))
+    finally:
+        session.close()
+
+
+def contact_artifact_keys(alpha_index: bool = False) -> list[str]:
+    """Keys of every artifact rendered by :func:`iter_contact_artifacts`."""
+    keys = ['all.xml', 'practices.xml', 'suppliers.xml', 'contacts.csv', 'contacts.vcf']
+    if alpha_index:
+        keys += [f'index/{letters}.xml' for letters in ALPHA_RANGES]
+    return keys
+
+
+def fits_render_cache(session_factory, max_rows: int) -> bool:
+    """Whether at most ``max_rows`` contacts are active; counts no further."""
+    session = session_factory()
+    try:
+        capped = (
+            session.query(Contact.id)
+            .filter(Contact.active == True)  # noqa: E712
+            .limit(max_rows + 1)
+            .subquery()
+        )
+        return session.query(func.count()).select_from(capped).scalar() <= max_rows
+    finally:
+        session.close()
+
+
+def iter_contact_artifacts(
+    session_factory,
+    key: str,
+    store: Callable[[dict[str, bytes]], None],
+    alpha_index: bool = False,
+) -> Iterator[bytes]:
+    """Stream artifact ``key`` while rendering all its siblings in one pass.
+
+    The ordered active contacts are read once and each row is routed to
+    every output it belongs to: ``all.xml``, the category directories, the
+    A-Z slices (when ``alpha_index`` is set), ``contacts.csv`` and
+    ``contacts.vcf``.  ``key`` is yielded in chunks as rows arrive; once the
+    stream completes, ``store`` receives the finished bytes of all other
+    artifacts.  Output is identical to rendering each artifact on its own.
+
+    The siblings are held in memory until then, so callers check
+    :func:`fits_render_cache` first and render large directories one
+    artifact at a time.
+    """
+    buffers: dict[str, list[str]] = {name: [] for name in contact_artifact_keys(alpha_index)}
+    csv_line = CsvLines()
+    buffers['contacts.csv'].append(csv_line(*CSV_COLUMNS))
+    categories = {'practice': buffers['practices.xml'], 'supplier': buffers['suppliers.xml']}
+    slices = []
+    if alpha_index:
+        for letters in ALPHA_RANGES:
+            first, last = letters.split('-')
+            slices.append((first, last, buffers[f'index/{letters}.xml']))
+    every = buffers['all.xml']
+    csv_lines = buffers['contacts.csv']
+    cards = buffers['contacts.vcf']
+
+    session = session_factory()
+    try:
+        rows = (
+            session.query(Contact.name, Contact.telephone, Contact.category)
+            .filter(Contact.active == True)  # noqa: E712
+            .order_by(Contact.name, Contact.id)
+            .yield_per(STREAM_BATCH_SIZE)
+        )
+
+        def pieces() -> Iterator[str]:
+            # the buffer of ``key`` is drained as it fills instead of kept
+            pending = buffers[key]
+            yield from pending
+            pending.clear()
+            for name, telephone, category in rows:
+                entry = directory_entry(name, telephone)
+                every.append(entry)
+                if category in categories:
+                    categories[category].append(entry)
+                # same rows as ``_letter_ranges``: ASCII initials only
+                initial = name[:1]
+                if slices and initial.isascii() and initial.isalpha():
+                    initial = initial.upper()
+                    for first, last, parts in slices:
+                        if first <= initial <= last:
+                            parts.append(entry)
+                            break
+                csv_lines.append(csv_line(name, telephone, category))
+                cards.append(vcard(name, telephone))
+                if pending:
+                    yield from pending
+                    pending.clear()
+
+        if key.endswith('.xml'):
+            yield from stream_directory(pieces())
+        else:
+            yield from _encode_batches(pieces())
+    finally:
+        session.close()
+
+    del buffers[key]
+    store({
+        name: b''.join(stream_directory(iter(parts))) if name.endswith('.xml') else ''.join(parts).encode('utf-8')
+        for name, parts in buffers.items()
+    })
+
+
+def contact_artifacts(session_factory, alpha_index: bool = False) -> dict[str, bytes]:
+    """Render every contact-based artifact in a single pass over the table."""
+    artifacts: dict[str, bytes] = {}
+    artifacts['all.xml'] = b''.join(iter_contact_artifacts(session_factory, 'all.xml', artifacts.update, alpha_index))
+    return artifacts
+
+
+def published_artifacts(session_factory) -> dict[str, bytes]:
+    """Render every file written by the publisher, keyed by file name.
+
+    Paging is not applied; the A-Z slices are included when the index is
+    enabled.  Must be called within a request context.
+    """
+    alpha_index = current_app.config['PHONEBOOK_ALPHA_INDEX']
+    artifacts = contact_artifacts(session_factory, alpha_index)
+    artifacts['root.xml'] = root_menu()
+    if alpha_index:
+        artifacts['index.xml'] = index_menu()
+    return artifacts
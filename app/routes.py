@@ -1,33 +1,53 @@
-from flask import Blueprint, render_template, request, redirect, url_for, abort, flash, jsonify
-from io import TextIOWrapper
+from flask import Blueprint, render_template, request, redirect, url_for, abort, flash, jsonify, current_app, send_file
 from .models import (
-    load_phonebook,
+    Contact,
+    get_contact,
+    get_contact_by_id,
     add_contact,
     delete_contact,
+    delete_contact_by_id,
     update_contact,
-    import_contacts,
-    import_contacts_xml,
+    update_contact_by_id,
 )
-from .utils import validate_contact
+from .jobs import DRY_RUN
+from .search import search_contacts
+from .utils import MAX_SQL_INT, validate_contact
 
 main_bp = Blueprint('main', __name__)
 
 @main_bp.route('/')
 def index():
+    """One page of active contacts, searched, filtered and paged in SQL.
+
+    Rows carry the contact id the edit and delete links take.  One extra row is fetched to tell whether a next page exists, so the
+    cost of a page does not depend on the size of the phonebook.
+    """
     q = request.args.get('q', '').strip()
     category = request.args.get('category', '').strip()
-    contacts = load_phonebook()
-    indexed = list(enumerate(contacts))
-    if q:
-        q_lower = q.lower()
-        indexed = [
-            (i, c)
-            for i, c in indexed
-            if q_lower in c['name'].lower() or q_lower in c['telephone'].lower()
-        ]
-    if category:
-        indexed = [(i, c) for i, c in indexed if c['category'] == category]
-    return render_template('index.html', contacts=indexed, q=q, category=category)
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = current_app.config['CONTACTS_PAGE_SIZE']
+    if (page - 1) * page_size > MAX_SQL_INT:
+        abort(400)
+    session = current_app.config['SESSION_FACTORY']()
+    try:
+        query = session.query(Contact.id, Contact.name, Contact.telephone, Contact.category)
+        query = query.filter(Contact.active == True)  # noqa: E712
+        if q:
+            query, _ = search_contacts(query, q.lower(), current_app.config['SEARCH_BACKEND'])
+        if category:
+            query = query.filter(Contact.category == category)
+        offset = (page - 1) * page_size
+        rows = query.order_by(Contact.name, Contact.id).offset(offset).limit(page_size + 1).all()
+    finally:
+        session.close()
+    has_next = len(rows) > page_size
+    contacts = [
+        (contact_id, {'name': name, 'telephone': telephone, 'category': cat})
+        for contact_id, name, telephone, cat in rows[:page_size]
+    ]
+    return render_template(
+        'index.html', contacts=contacts, q=q, category=category, page=page, has_next=has_next,
+    )
 
 
 @main_bp.route('/add', methods=['GET', 'POST'])
@@ -42,9 +62,7 @@ def add():
     return render_template('add.html')
 
 
-@main_bp.route('/delete/<int:index>', methods=['POST', 'DELETE'])
-def delete(index):
-    success = delete_contact(index)
+def _delete_response(success):
     if request.method == 'POST':
         return redirect(url_for('main.index'))
     if success:
@@ -52,20 +70,69 @@ def delete(index):
     return jsonify({'error': 'Not found'}), 404
 
 
-@main_bp.route('/edit/<int:index>', methods=['GET', 'POST'])
-def edit(index):
-    contacts = load_phonebook()
-    if not (0 <= index < len(contacts)):
+def _edit_response(contact, update):
+    if contact is None:
         abort(404)
     if request.method == 'POST':
         name = request.form.get('name')
         telephone = request.form.get('telephone')
         category = request.form.get('category', 'other')
         if validate_contact(name, telephone):
-            update_contact(index, name, telephone, category)
+            update(name, telephone, category)
+            return redirect(url_for('main.index'))
+    return render_template('edit.html', contact=contact)
+
+
+@main_bp.route('/contacts/<int:contact_id>/delete', methods=['POST', 'DELETE'])
+def delete_by_id(contact_id):
+    return _delete_response(delete_contact_by_id(contact_id))
+
+
+@main_bp.route('/contacts/<int:contact_id>/edit', methods=['GET', 'POST'])
+def edit_by_id(contact_id):
+    return _edit_response(
+        get_contact_by_id(contact_id),
+        lambda *fields: update_contact_by_id(contact_id, *fields),
+    )
+
+
+@main_bp.route('/delete/<int:index>', methods=['POST', 'DELETE'])
+def delete(index):
+    """Delete by sorted position; kept for old links, the list links by id."""
+    return _delete_response(delete_contact(index))
+
+
+@main_bp.route('/edit/<int:index>', methods=['GET', 'POST'])
+def edit(index):
+    """Edit by sorted position; kept for old links, the list links by id."""
+    return _edit_response(get_contact(index), lambda *fields: update_contact(index, *fields))
+
+
+def _flash_import_result(job):
+    stats = job.stats
+    if job.status == 'failed':
+        flash(f"Importeren mislukt: {job.error}", "error")
+    elif job.mode == 'upsert':
+        flash(
+            f"{stats.inserted} toegevoegd, {stats.updated} bijgewerkt, "
+            f"{stats.skipped} overgeslagen.",
+            "info",
+        )
+    elif stats.inserted:
+        flash(f"{stats.inserted} contacten ge\u00efmporteerd.", "info")
+
+
+def _start_import(job):
+    jobs = current_app.config['IMPORT_JOBS']
+    if job.size <= current_app.config['IMPORT_INLINE_MAX_BYTES']:
+        # small files are done before a job page could refresh
+        jobs.run(job)
+        if job.mode != DRY_RUN:
+            _flash_import_result(job)
             return redirect(url_for('main.index'))
-    contact = contacts[index]
-    return render_template('edit.html', contact=contact, index=index)
+    else:
+        jobs.submit(job)
+    return redirect(url_for('main.import_job', job_id=job.id))
 
 
 @main_bp.route('/import', methods=['GET', 'POST'])
@@ -73,14 +140,49 @@ def import_view():
     if request.method == 'POST':
         file = request.files.get('file')
         if file:
-            text_file = TextIOWrapper(file.stream, encoding="utf-8")
-            filename = (file.filename or "").lower()
-            if filename.endswith(".xml"):
-                count = import_contacts_xml(text_file, validate_contact)
+            jobs = current_app.config['IMPORT_JOBS']
+            if request.form.get('dry_run'):
+                mode = DRY_RUN
             else:
-                count = import_contacts(text_file, validate_contact)
-            if count:
-                flash(f"{count} contacten ge\u00efmporteerd.", "info")
-            return redirect(url_for('main.index'))
+                mode = 'upsert' if request.form.get('upsert') else 'insert'
+            job = jobs.spool(file.stream, file.filename or "", mode=mode)
+            return _start_import(job)
         flash('Geen bestand ge\u00fcppload.', 'error')
     return render_template('import.html')
+
+
+@main_bp.route('/import/jobs/<job_id>')
+def import_job(job_id):
+    job = current_app.config['IMPORT_JOBS'].get(job_id)
+    if job is None:
+        abort(404)
+    return render_template('import_job.html', job=job.to_dict())
+
+
+@main_bp.route('/import/jobs/<job_id>/report.csv')
+def import_job_report(job_id):
+    """Download the adds, updates and no-ops found by a dry run."""
+    job = current_app.config['IMPORT_JOBS'].get(job_id)
+    if job is None or job.report is None or job.status != 'done' or not job.report.is_file():
+        abort(404)
+    return send_file(
+        job.report,
+        mimetype='text/csv',
+        as_attachment=True,
+        download_name=f'{job.filename}.diff.csv',
+    )
+
+
+@main_bp.route('/import/jobs/<job_id>/apply', methods=['POST'])
+def apply_import_job(job_id):
+    """Write the changes of a dry run in a single transaction."""
+    jobs = current_app.config['IMPORT_JOBS']
+    dry_run = jobs.get(job_id)
+    if dry_run is None:
+        abort(404)
+    try:
+        job = jobs.apply(dry_run)
+    except ValueError as exc:
+        flash(str(exc), 'error')
+        return redirect(url_for('main.import_job', job_id=job_id))
+    return _start_import(job)
@@ -1,4 +1,6 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, jsonify, current_app, url_for
+from sqlalchemy import tuple_
+import json
 import re
 
 from .models import (
@@ -9,44 +11,147 @@ from .models import (
     PhoneNumber,
     PracticeContact,
     SupplierContact,
+    get_data_version,
+    mark_changed,
 )
-from .utils import validate_contact_data, PHONE_RE
+from .search import search_contacts
+from .utils import encode_cursor, number_digits, parse_cursor, parse_since, validate_contact_data, PHONE_RE
 
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 EMAIL_RE = re.compile(r'^[^@]+@[^@]+\.[^@]+$')
+NDJSON = 'application/x-ndjson'
+# rows fetched and encoded per chunk of a streamed listing
+LIST_BATCH_SIZE = 500
+# page size of ``?cursor=`` without ``?limit=``, and the largest page served
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
 
 
 def _session():
     return current_app.config['SESSION_FACTORY']()
 
 
+def _page_args(keys):
+    """Parse ``?limit=`` and ``?cursor=``; ``(None, None)`` lists everything."""
+    after = parse_cursor(request.args.get('cursor'), [key.type.python_type for key in keys])
+    limit = request.args.get('limit')
+    if limit is None or limit == '':
+        return (DEFAULT_PAGE_LIMIT, after) if after is not None else (None, None)
+    if not limit.isdigit() or int(limit) < 1:
+        raise ValueError(f'invalid limit {limit!r}')
+    return min(int(limit), MAX_PAGE_LIMIT), after
+
+
+def _list_response(session, query, headers=None, keys=None):
+    """Return the column rows of ``query`` as a JSON list of objects.
+
+    ``Accept: application/x-ndjson`` streams one object per line and
+    ``?stream=1`` streams a JSON array; both encode rows as they are fetched
+    in batches of ``LIST_BATCH_SIZE``.  Otherwise the list is built and
+    sent with ``jsonify``.  ``session`` is closed once the rows are sent.
+
+    ``keys`` are the columns ``query`` is ordered by, ending in a unique
+    one.  With ``?limit=`` one page is returned and the cursor of the next
+    page, if any, goes in the ``X-Next-Cursor`` and ``Link`` headers.  The
+    cursor holds the keys of the last row, so a page is found by an index
+    seek however deep it is.
+    """
+    headers = dict(headers or {})
+    limit = None
+    if keys is not None:
+        try:
+            limit, after = _page_args(keys)
+        except ValueError:
+            session.close()
+            return jsonify({'error': 'Invalid limit or cursor'}), 400
+    if limit is not None:
+        if after is not None:
+            query = query.filter(tuple_(*keys) > tuple_(*after))
+        rows = query.limit(limit + 1).all()
+        session.close()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = encode_cursor(rows[-1]._mapping[key] for key in keys)
+            args = {**request.args.to_dict(), 'limit': limit, 'cursor': cursor}
+            headers['X-Next-Cursor'] = cursor
+            headers['Link'] = f'<{url_for(request.endpoint, **request.view_args, **args)}>; rel="next"'
+        query = rows
+    ndjson = request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+    stream = ndjson or request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+    if not stream:
+        result = [row._asdict() for row in query]
+        session.close()
+        response = jsonify(result)
+        response.headers.update(headers)
+        return response
+
+    def generate():
+        try:
+            chunk = []
+            first = True
+            rows = query if limit is not None else query.yield_per(LIST_BATCH_SIZE)
+            for row in rows:
+                item = json.dumps(row._asdict(), separators=(',', ':'))
+                if ndjson:
+                    chunk.append(item + '\n')
+                else:
+                    chunk.append(('[' if first else ',') + item)
+                first = False
+                if len(chunk) >= LIST_BATCH_SIZE:
+                    yield ''.join(chunk).encode('utf-8')
+                    chunk = []
+            if not ndjson:
+                chunk.append('[]' if first else ']')
+            if chunk:
+                yield ''.join(chunk).encode('utf-8')
+        finally:
+            session.close()
+
+    return Response(generate(), content_type=NDJSON if ndjson else 'application/json', headers=headers)
+
+
 @api_bp.get('/contacts')
 @api_bp.get('/contacts/')  # allow trailing slash
 
 def list_contacts():
+    """Active contacts, or with ``?since=<token>`` every contact changed since.
+
+    ``?q=`` searches names and numbers through the full-text backend and
+    ranks the results.
+
+    Change listings include soft-deleted contacts (``active`` false) and
+    their ``change_seq``; the ``X-Change-Token`` header holds the token for
+    the next call.  ``?limit=`` and ``?cursor=`` page any of these listings.
+    """
+    try:
+        since = parse_since(request.args.get('since'))
+    except ValueError:
+        return jsonify({'error': 'Invalid since token'}), 400
     session = _session()
-    query = session.query(Contact).filter(Contact.active == True)  # noqa: E712
+    # read the token first so rows committed meanwhile are not skipped
+    version, _ = get_data_version(session)
+    columns = [Contact.id, Contact.name, Contact.telephone, Contact.category]
+    if since is None:
+        query = session.query(*columns).filter(Contact.active == True)  # noqa: E712
+        keys = [Contact.name, Contact.id]
+    else:
+        query = session.query(*columns, Contact.active, Contact.change_seq).filter(Contact.change_seq > since)
+        keys = [Contact.change_seq, Contact.id]
     q = request.args.get('q', '').strip().lower()
+    rank = []
     if q:
-        query = query.filter(
-            (Contact.name.ilike(f'%{q}%')) | (Contact.telephone.ilike(f'%{q}%'))
-        )
+        query, rank = search_contacts(query, q, current_app.config['SEARCH_BACKEND'])
     category = request.args.get('category', '').strip()
     if category:
         query = query.filter(Contact.category == category)
-    contacts = query.order_by(Contact.name).all()
-    result = [
-        {
-            'id': c.id,
-            'name': c.name,
-            'telephone': c.telephone,
-            'category': c.category,
-        }
-        for c in contacts
-    ]
-    session.close()
-    return jsonify(result)
+    if since is None and 'limit' not in request.args and 'cursor' not in request.args:
+        # best matches first when searching, then alphabetical
+        query = query.order_by(*rank, Contact.name, Contact.id)
+    else:
+        # pages are cut on the keys alone, so a paged search is alphabetical
+        query = query.order_by(*keys)
+    return _list_response(session, query, {'X-Change-Token': str(version)}, keys)
 
 
 @api_bp.post('/contacts')
@@ -63,6 +168,7 @@ def create_contact():
     session = _session()
     contact = Contact(name=name, telephone=telephone, category=category)
     session.add(contact)
+    mark_changed(session)
     session.commit()
     result = {
         'id': contact.id,
@@ -93,6 +199,7 @@ def update_contact(contact_id):
     contact.name = name
     contact.telephone = telephone
     contact.category = category
+    mark_changed(session)
     session.commit()
     result = {
         'id': contact.id,
@@ -113,11 +220,41 @@ def delete_contact(contact_id):
         session.close()
         return jsonify({'error': 'Not found'}), 404
     contact.active = False
+    mark_changed(session)
     session.commit()
     session.close()
     return ('', 204)
 
 
+@api_bp.get('/lookup')
+def lookup_number():
+    """Caller-ID: resolve ``?number=`` to contacts, organizations and persons.
+
+    Exact digit matches are returned when there are any, otherwise matches
+    on the trailing digits (e.g. the same number with or without country
+    code).  Served from the in-process number index of the data version.
+    """
+    number = request.args.get('number', '').strip()
+    if not number_digits(number):
+        return jsonify({'error': 'Invalid number'}), 400
+    session = _session()
+    try:
+        version, _ = get_data_version(session)
+    finally:
+        session.close()
+    match, results = current_app.config['NUMBER_INDEX'].get(version).lookup(number)
+    return jsonify({'number': number, 'match': match, 'results': results})
+
+
+@api_bp.get('/import-jobs/<job_id>')
+def import_job_status(job_id):
+    """Progress of a background import started from the import page."""
+    job = current_app.config['IMPORT_JOBS'].get(job_id)
+    if job is None:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(job.to_dict())
+
+
 # ---------------------------------------------------------------------------
 # Helper validators
 
@@ -137,10 +274,9 @@ def _valid_phone(number: str | None) -> bool:
 @api_bp.get('/practices')
 def list_practices():
     session = _session()
-    practices = session.query(Practice).order_by(Practice.name).all()
-    result = [{'id': p.id, 'name': p.name, 'email': p.email} for p in practices]
-    session.close()
-    return jsonify(result)
+    keys = [Practice.name, Practice.id]
+    query = session.query(Practice.id, Practice.name, Practice.email).order_by(*keys)
+    return _list_response(session, query, keys=keys)
 
 
 @api_bp.post('/practices')
@@ -153,6 +289,7 @@ def create_practice():
     session = _session()
     practice = Practice(name=name, email=email)
     session.add(practice)
+    mark_changed(session)
     session.commit()
     result = {'id': practice.id, 'name': practice.name, 'email': practice.email}
     session.close()
@@ -174,6 +311,7 @@ def update_practice(practice_id):
         return jsonify({'error': 'Invalid data'}), 400
     practice.name = name
     practice.email = email
+    mark_changed(session)
     session.commit()
     result = {'id': practice.id, 'name': practice.name, 'email': practice.email}
     session.close()
@@ -188,6 +326,7 @@ def delete_practice(practice_id):
         session.close()
         return jsonify({'error': 'Not found'}), 404
     session.delete(practice)
+    mark_changed(session)
     session.commit()
     session.close()
     return ('', 204)
@@ -219,6 +358,7 @@ def add_practice_phone(practice_id):
         return jsonify({'error': 'Not found'}), 404
     phone = PhoneNumber(number=number, type=ptype, practice=practice)
     session.add(phone)
+    mark_changed(session)
     session.commit()
     result = {'id': phone.id, 'number': phone.number, 'type': phone.type}
     session.close()
@@ -260,6 +400,7 @@ def link_practice_contact(practice_id):
         return jsonify({'error': 'Not found'}), 404
     link = PracticeContact(practice=practice, contact=contact, role=role, is_primary=is_primary)
     session.add(link)
+    mark_changed(session)
     session.commit()
     session.close()
     return ('', 204)
@@ -277,6 +418,7 @@ def unlink_practice_contact(practice_id, contact_id):
         session.close()
         return jsonify({'error': 'Not found'}), 404
     session.delete(link)
+    mark_changed(session)
     session.commit()
     session.close()
     return ('', 204)
@@ -289,10 +431,9 @@ def unlink_practice_contact(practice_id, contact_id):
 @api_bp.get('/suppliers')
 def list_suppliers():
     session = _session()
-    suppliers = session.query(Supplier).order_by(Supplier.name).all()
-    result = [{'id': s.id, 'name': s.name, 'email': s.email} for s in suppliers]
-    session.close()
-    return jsonify(result)
+    keys = [Supplier.name, Supplier.id]
+    query = session.query(Supplier.id, Supplier.name, Supplier.email).order_by(*keys)
+    return _list_response(session, query, keys=keys)
 
 
 @api_bp.post('/suppliers')
@@ -305,6 +446,7 @@ def create_supplier():
     session = _session()
     supplier = Supplier(name=name, email=email)
     session.add(supplier)
+    mark_changed(session)
     session.commit()
     result = {'id': supplier.id, 'name': supplier.name, 'email': supplier.email}
     session.close()
@@ -326,6 +468,7 @@ def update_supplier(supplier_id):
         return jsonify({'error': 'Invalid data'}), 400
     supplier.name = name
     supplier.email = email
+    mark_changed(session)
     session.commit()
     result = {'id': supplier.id, 'name': supplier.name, 'email': supplier.email}
     session.close()
@@ -340,6 +483,7 @@ def delete_supplier(supplier_id):
         session.close()
         return jsonify({'error': 'Not found'}), 404
     session.delete(supplier)
+    mark_changed(session)
     session.commit()
     session.close()
     return ('', 204)
@@ -371,6 +515,7 @@ def add_supplier_phone(supplier_id):
         return jsonify({'error': 'Not found'}), 404
     phone = PhoneNumber(number=number, type=ptype, supplier=supplier)
     session.add(phone)
+    mark_changed(session)
     session.commit()
     result = {'id': phone.id, 'number': phone.number, 'type': phone.type}
     session.close()
@@ -412,6 +557,7 @@ def link_supplier_contact(supplier_id):
         return jsonify({'error': 'Not found'}), 404
     link = SupplierContact(supplier=supplier, contact=contact, role=role, is_primary=is_primary)
     session.add(link)
+    mark_changed(session)
     session.commit()
     session.close()
     return ('', 204)
@@ -429,6 +575,7 @@ def unlink_supplier_contact(supplier_id, contact_id):
         session.close()
         return jsonify({'error': 'Not found'}), 404
     session.delete(link)
+    mark_changed(session)
     session.commit()
     session.close()
     return ('', 204)
@@ -441,19 +588,15 @@ def unlink_supplier_contact(supplier_id, contact_id):
 @api_bp.get('/contact-persons')
 def list_contact_persons():
     session = _session()
-    persons = session.query(ContactPerson).order_by(ContactPerson.last_name).all()
-    result = [
-        {
-            'id': p.id,
-            'first_name': p.first_name,
-            'last_name': p.last_name,
-            'email': p.email,
-            'function': p.function,
-        }
-        for p in persons
-    ]
-    session.close()
-    return jsonify(result)
+    keys = [ContactPerson.last_name, ContactPerson.id]
+    query = session.query(
+        ContactPerson.id,
+        ContactPerson.first_name,
+        ContactPerson.last_name,
+        ContactPerson.email,
+        ContactPerson.function,
+    ).order_by(*keys)
+    return _list_response(session, query, keys=keys)
 
 
 @api_bp.post('/contact-persons')
@@ -468,6 +611,7 @@ def create_contact_person():
     session = _session()
     person = ContactPerson(first_name=first, last_name=last, email=email, function=function)
     session.add(person)
+    mark_changed(session)
     session.commit()
     result = {
         'id': person.id,
@@ -499,6 +643,7 @@ def update_contact_person(person_id):
     person.last_name = last
     person.email = email
     person.function = function
+    mark_changed(session)
     session.commit()
     result = {
         'id': person.id,
@@ -519,6 +664,7 @@ def delete_contact_person(person_id):
         session.close()
         return jsonify({'error': 'Not found'}), 404
     session.delete(person)
+    mark_changed(session)
     session.commit()
     session.close()
     return ('', 204)
@@ -550,6 +696,7 @@ def add_contact_person_phone(person_id):
         return jsonify({'error': 'Not found'}), 404
     phone = PhoneNumber(number=number, type=ptype, contact_person=person)
     session.add(phone)
+    mark_changed(session)
     session.commit()
     result = {'id': phone.id, 'number': phone.number, 'type': phone.type}
     session.close()
@@ -1,62 +1,177 @@
-from flask import Blueprint, Response, current_app
+from flask import Blueprint, Response, abort, current_app, jsonify, request, send_file, url_for
 
-from .models import Contact
+from .cache import artifact_response, data_version
+from .models import get_deleted_seq
+from .render import (
+    VCARD_CATEGORIES,
+    fits_render_cache,
+    iter_contact_artifacts,
+    iter_contact_changes_csv,
+    iter_contacts_csv,
+    iter_contacts_vcf,
+    iter_vcards,
+)
+from .utils import parse_since
 
 
 export_bp = Blueprint('export', __name__, url_prefix='/export')
 
 
-def _session():
-    return current_app.config['SESSION_FACTORY']()
+def _since():
+    try:
+        return parse_since(request.args.get('since'))
+    except ValueError:
+        abort(400)
 
 
-@export_bp.route('/contacts.csv')
-def export_csv():
-    session = _session()
-    contacts = (
-        session.query(Contact)
-        .filter(Contact.active == True)  # noqa: E712
-        .order_by(Contact.name)
-        .all()
-    )
-    session.close()
+def _changes_response(key, content_type, render, since=None, resync=None):
+    """Stream the rows changed after ``?since=`` uncached, with the new token.
+
+    When ``resync`` is given and a record was hard-deleted after ``since``,
+    ``resync()`` is streamed instead with ``X-Full-Resync: 1``: a delta of
+    changed rows has no way to tell the client a record is gone.
+    """
+    # read the token first: rows committed meanwhile are sent again next time,
+    # never skipped
+    version, _ = data_version()
+    headers = {
+        'Content-Disposition': f'attachment; filename={key}',
+        'X-Change-Token': str(version),
+    }
+    if resync is not None:
+        session = current_app.config['SESSION_FACTORY']()
+        try:
+            deleted_seq = get_deleted_seq(session)
+        finally:
+            session.close()
+        if deleted_seq > since:
+            headers['X-Full-Resync'] = '1'
+            render = resync
+    return Response(render(), content_type=content_type, headers=headers)
 
-    def generate():
-        yield 'name,telephone,category\n'
-        for c in contacts:
-            yield f'{c.name},{c.telephone},{c.category}\n'
 
+def _export_response(key, content_type, stream, headers=None):
+    session_factory = current_app.config['SESSION_FACTORY']
+    alpha_index = current_app.config['PHONEBOOK_ALPHA_INDEX']
+    max_rows = current_app.config['RENDER_CACHE_MAX_ROWS']
     headers = {
-        'Content-Disposition': 'attachment; filename=contacts.csv'
+        'Content-Disposition': f'attachment; filename={key}',
+        **(headers or {}),
     }
-    return Response(generate(), mimetype='text/csv', headers=headers)
+    return artifact_response(
+        key,
+        lambda store: iter_contact_artifacts(session_factory, key, store, alpha_index),
+        content_type,
+        headers,
+        flight='contacts',
+        change_token=True,
+        bypass=lambda: None if fits_render_cache(session_factory, max_rows) else stream(session_factory),
+    )
+
+
+@export_bp.route('/contacts.csv')
+def export_csv():
+    """All active contacts, or with ``?since=`` every contact changed since."""
+    since = _since()
+    if since is not None:
+        session_factory = current_app.config['SESSION_FACTORY']
+        return _changes_response(
+            'contacts-changes.csv',
+            'text/csv; charset=utf-8',
+            lambda: iter_contact_changes_csv(session_factory, since),
+        )
+    return _export_response('contacts.csv', 'text/csv; charset=utf-8', iter_contacts_csv)
 
 
 @export_bp.route('/contacts.vcf')
 def export_vcf():
-    session = _session()
-    contacts = (
-        session.query(Contact)
-        .filter(Contact.active == True)  # noqa: E712
-        .order_by(Contact.name)
-        .all()
+    """All active contacts.
+
+    These cards carry no id a client could match deletions on, so
+    ``?since=`` is answered with everything and ``X-Full-Resync: 1``.
+    """
+    headers = {'X-Full-Resync': '1'} if _since() is not None else None
+    return _export_response('contacts.vcf', 'text/vcard; charset=utf-8', iter_contacts_vcf, headers)
+
+
+@export_bp.route('/directory.vcf')
+def export_directory_vcf():
+    """Practices, suppliers and contact persons with all numbers and addresses.
+
+    ``?category=practice|supplier|person`` and ``?organization=<name>``
+    narrow the export and ``?since=<token>`` limits it to entities changed
+    since, or answers with everything and ``X-Full-Resync: 1`` when one was
+    deleted since.  Category variants are cached per data version; organization and
+    change filters are streamed straight from the database.
+    """
+    category = request.args.get('category', '').strip().lower() or None
+    if category is not None and category not in VCARD_CATEGORIES:
+        abort(400)
+    organization = request.args.get('organization', '').strip().lower() or None
+    since = _since()
+    session_factory = current_app.config['SESSION_FACTORY']
+    key = f'directory-{category}.vcf' if category else 'directory.vcf'
+    content_type = 'text/vcard; charset=utf-8'
+    headers = {'Content-Disposition': f'attachment; filename={key}'}
+    if since is not None:
+        return _changes_response(
+            key,
+            content_type,
+            lambda: iter_vcards(session_factory, category, organization, since),
+            since,
+            resync=lambda: iter_vcards(session_factory, category, organization),
+        )
+    if organization:
+        return Response(iter_vcards(session_factory, category, organization), content_type=content_type, headers=headers)
+    return artifact_response(
+        key, lambda store: iter_vcards(session_factory, category), content_type, headers, change_token=True,
     )
-    session.close()
-
-    def generate():
-        for c in contacts:
-            parts = c.name.split(' ', 1)
-            first = parts[0]
-            last = parts[1] if len(parts) > 1 else ''
-            full = c.name
-            yield 'BEGIN:VCARD\n'
-            yield 'VERSION:3.0\n'
-            yield f'N:{last};{first}\n'
-            yield f'FN:{full}\n'
-            yield f'TEL;TYPE=CELL:{c.telephone}\n'
-            yield 'END:VCARD\n'
 
-    headers = {
-        'Content-Disposition': 'attachment; filename=contacts.vcf'
-    }
-    return Response(generate(), mimetype='text/vcard', headers=headers)
+
+def _job_status(job):
+    data = job.to_dict()
+    data['status_url'] = url_for('export.export_job_status', job_id=job.id)
+    if job.status == 'done':
+        data['download_url'] = url_for('export.export_job_download', job_id=job.id)
+    return data
+
+
+@export_bp.post('/jobs')
+def start_export_job():
+    """Build a zip with XML, CSV and VCF per category in the background.
+
+    Answers ``202`` with the new job, or ``200`` with the existing job when
+    the current data version is already being bundled or was bundled.
+    """
+    job, created = current_app.config['EXPORT_JOBS'].start()
+    status_url = url_for('export.export_job_status', job_id=job.id)
+    return jsonify(_job_status(job)), 202 if created else 200, {'Location': status_url}
+
+
+@export_bp.get('/jobs/<job_id>')
+def export_job_status(job_id):
+    job = current_app.config['EXPORT_JOBS'].get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(_job_status(job))
+
+
+@export_bp.get('/jobs/<job_id>/download')
+def export_job_download(job_id):
+    """Serve a finished bundle; ``Range`` requests resume broken downloads."""
+    job = current_app.config['EXPORT_JOBS'].get(job_id)
+    if job is None:
+        abort(404)
+    if job.status != 'done':
+        return jsonify(_job_status(job)), 409
+    try:
+        return send_file(
+            job.path,
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name=f'phonebook-{job.version}.zip',
+            conditional=True,
+        )
+    except FileNotFoundError:
+        # pruned by another worker since ``get`` looked
+        abort(404)
@@ -1,84 +1,145 @@
 from __future__ import annotations
 
-from hashlib import md5
-from datetime import datetime, timezone
-from email.utils import format_datetime, parsedate_to_datetime
-from flask import Blueprint, Response, current_app, request, url_for
-import xml.etree.ElementTree as ET
-import os
-
-from .models import Contact
+from typing import Callable, Iterable
+from flask import Blueprint, Response, abort, current_app, g, request, url_for
+from time import monotonic
+import re
+
+from .cache import artifact_response, data_version
+from .render import (
+    contact_artifact_keys,
+    directory_entry,
+    fits_render_cache,
+    index_menu,
+    iter_contact_artifacts,
+    iter_contacts_xml,
+    root_menu,
+    stream_directory,
+)
+from .telemetry import CountingIterable
+from .utils import MAX_SQL_INT
 
 xml_bp = Blueprint('xml', __name__, url_prefix='/phonebook')
 
+LETTERS_RE = re.compile(r'^([A-Z])(?:-([A-Z]))?$')
+SEARCH_LIMIT = 50
+
+
+@xml_bp.before_request
+def _start_poll_timer() -> None:
+    g.poll_started = monotonic()
+
+
+@xml_bp.after_request
+def _record_poll(response: Response) -> Response:
+    """Feed status, bytes sent and duration of each poll to ``POLL_STATS``."""
+    stats = current_app.config['POLL_STATS']
+    endpoint = request.url_rule.rule if request.url_rule else request.path
+    client = request.remote_addr or '-'
+    user_agent = request.user_agent.string
+    status = response.status_code
+
+    def _done(nbytes: int, duration: float) -> None:
+        stats.record(endpoint, client, user_agent, status, nbytes, duration)
+
+    response.response = CountingIterable(response.response, g.poll_started, _done)
+    return response
+
+
+def _xml_response(key: str, render: Callable[..., Iterable[bytes]]) -> Response:
+    return artifact_response(key, render, 'application/xml')
 
-def _db_timestamp() -> datetime:
-    db_path = current_app.config['DB_PATH']
-    return datetime.fromtimestamp(os.path.getmtime(db_path), tz=timezone.utc)
-
-
-def _xml_response(xml_bytes: bytes) -> Response:
-    etag = md5(xml_bytes).hexdigest()
-    last_modified = _db_timestamp()
-    headers = {
-        'ETag': etag,
-        'Last-Modified': format_datetime(last_modified, usegmt=True),
-        'Content-Type': 'application/xml',
-    }
-    if request.headers.get('If-None-Match') == etag:
-        return Response(status=304, headers=headers)
-    ims = request.headers.get('If-Modified-Since')
-    if ims:
-        try:
-            ims_dt = parsedate_to_datetime(ims)
-            if ims_dt >= last_modified.replace(microsecond=0):
-                return Response(status=304, headers=headers)
-        except Exception:
-            pass
-    return Response(xml_bytes, headers=headers)
+
+def _directory_response(key: str, category: str | None = None, letters: tuple[str, str] | None = None) -> Response:
+    page_size = current_app.config['PHONEBOOK_PAGE_SIZE']
+    page = max(request.args.get('page', 1, type=int), 1) if page_size else 1
+    if (page - 1) * page_size > MAX_SQL_INT:
+        # the OFFSET would not fit the database's integers
+        abort(400)
+    if page_size:
+        key = f'{key}?page={page}'
+    base_url = url_for(request.endpoint, **request.view_args)
+    session_factory = current_app.config['SESSION_FACTORY']
+    alpha_index = current_app.config['PHONEBOOK_ALPHA_INDEX']
+
+    single_pass = not page_size and key in contact_artifact_keys(alpha_index)
+    max_rows = current_app.config['RENDER_CACHE_MAX_ROWS']
+
+    def render(store):
+        if single_pass:
+            # stream this directory and fill its siblings in the same pass
+            return iter_contact_artifacts(session_factory, key, store, alpha_index)
+        return iter_contacts_xml(
+            session_factory,
+            category,
+            letters,
+            page=page,
+            page_size=page_size,
+            page_url=lambda n: f'{base_url}?page={n}',
+        )
+
+    def bypass():
+        if single_pass and not fits_render_cache(session_factory, max_rows):
+            return iter_contacts_xml(session_factory, category, letters)
+        return None
+
+    return artifact_response(
+        key, render, 'application/xml', flight='contacts' if single_pass else None, bypass=bypass,
+    )
 
 
 @xml_bp.route('/root.xml')
 def root_xml() -> Response:
-    root = ET.Element('YealinkIPPhoneDirectory')
-    items = [
-        ('All', url_for('xml.all_xml', _external=False)),
-        ('Practices', url_for('xml.practices_xml', _external=False)),
-        ('Suppliers', url_for('xml.suppliers_xml', _external=False)),
-    ]
-    for name, url in items:
-        mi = ET.SubElement(root, 'MenuItem')
-        ET.SubElement(mi, 'Name').text = name
-        ET.SubElement(mi, 'URL').text = url
-    xml_bytes = ET.tostring(root, encoding='utf-8', xml_declaration=True)
-    return _xml_response(xml_bytes)
-
-
-def _contacts_xml(category: str | None = None) -> bytes:
-    session = current_app.config['SESSION_FACTORY']()
-    query = session.query(Contact).filter(Contact.active == True)  # noqa: E712
-    if category:
-        query = query.filter(Contact.category == category)
-    contacts = query.order_by(Contact.name).all()
-    session.close()
-    root = ET.Element('YealinkIPPhoneDirectory')
-    for c in contacts:
-        entry = ET.SubElement(root, 'DirectoryEntry')
-        ET.SubElement(entry, 'Name').text = c.name
-        ET.SubElement(entry, 'Telephone').text = c.telephone
-    return ET.tostring(root, encoding='utf-8', xml_declaration=True)
+    return _xml_response('root.xml', lambda store: [root_menu()])
+
+
+@xml_bp.route('/index.xml')
+def index_xml() -> Response:
+    """Submenu linking to the letter-range slices of the directory."""
+    if not current_app.config['PHONEBOOK_ALPHA_INDEX']:
+        abort(404)
+    return _xml_response('index.xml', lambda store: [index_menu()])
+
+
+@xml_bp.route('/index/<letters>.xml')
+def letters_xml(letters: str) -> Response:
+    match = LETTERS_RE.match(letters)
+    if not current_app.config['PHONEBOOK_ALPHA_INDEX'] or not match:
+        abort(404)
+    first, last = match.group(1), match.group(2) or match.group(1)
+    if first > last:
+        abort(404)
+    return _directory_response(f'index/{letters}.xml', letters=(first, last))
 
 
 @xml_bp.route('/all.xml')
 def all_xml() -> Response:
-    return _xml_response(_contacts_xml())
+    return _directory_response('all.xml')
 
 
 @xml_bp.route('/practices.xml')
 def practices_xml() -> Response:
-    return _xml_response(_contacts_xml('practice'))
+    return _directory_response('practices.xml', 'practice')
 
 
 @xml_bp.route('/suppliers.xml')
 def suppliers_xml() -> Response:
-    return _xml_response(_contacts_xml('supplier'))
+    return _directory_response('suppliers.xml', 'supplier')
+
+
+@xml_bp.route('/search.xml')
+def search_xml() -> Response:
+    """Remote phonebook search on a name or number prefix.
+
+    Configure the handset with ``/phonebook/search.xml?q=#SEARCH``.  Results
+    come from the in-process prefix index, rebuilt once per data version.
+    """
+    q = request.args.get('q', '').strip()
+    matches = []
+    if q:
+        version, _ = data_version()
+        matches = current_app.config['PREFIX_INDEX'].get(version).search(q, SEARCH_LIMIT)
+    xml_bytes = b''.join(stream_directory(
+        directory_entry(name, telephone) for name, telephone in matches
+    ))
+    return Response(xml_bytes, content_type='application/xml')
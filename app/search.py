@@ -0,0 +1,219 @@
+"""Contact search: database full-text backends and in-process indexes.
+
+``list_contacts`` searches through :func:`search_contacts`, which uses an
+FTS5 trigram table kept in sync by triggers on SQLite and ``pg_trgm`` GIN
+indexes on PostgreSQL, so substring searches do not scan the whole table.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_left
+from typing import Iterable
+
+from sqlalchemy import column, func, table, text
+from sqlalchemy.exc import DBAPIError
+
+from .models import Contact, ContactPerson, PhoneNumber, Practice, Supplier
+from .utils import number_digits
+
+# Trigram indexes need this many characters to narrow a search down.
+MIN_TRIGRAM_QUERY = 3
+
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE contacts_fts USING fts5("
+    "name, telephone, content='contacts', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER contacts_fts_ai AFTER INSERT ON contacts BEGIN "
+    "INSERT INTO contacts_fts(rowid, name, telephone) VALUES (new.id, new.name, new.telephone); END",
+    "CREATE TRIGGER contacts_fts_ad AFTER DELETE ON contacts BEGIN "
+    "INSERT INTO contacts_fts(contacts_fts, rowid, name, telephone) "
+    "VALUES ('delete', old.id, old.name, old.telephone); END",
+    "CREATE TRIGGER contacts_fts_au AFTER UPDATE OF name, telephone ON contacts BEGIN "
+    "INSERT INTO contacts_fts(contacts_fts, rowid, name, telephone) "
+    "VALUES ('delete', old.id, old.name, old.telephone); "
+    "INSERT INTO contacts_fts(rowid, name, telephone) VALUES (new.id, new.name, new.telephone); END",
+    "INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild')",
+)
+POSTGRES_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_contacts_name_trgm ON contacts USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_contacts_telephone_trgm ON contacts USING gin (telephone gin_trgm_ops)",
+)
+
+_fts = table('contacts_fts', column('rowid'), column('rank'))
+
+
+def setup_search(engine) -> str:
+    """Create the search structures if missing and return the backend name.
+
+    Returns ``'fts5'`` or ``'trgm'``, or ``'like'`` when the database lacks
+    the feature (e.g. SQLite without the trigram tokenizer).
+    """
+    dialect = engine.dialect.name
+    try:
+        with engine.begin() as conn:
+            if dialect == 'sqlite':
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'contacts_fts'"
+                )).first()
+                if not exists:
+                    for statement in SQLITE_SEARCH_DDL:
+                        conn.execute(text(statement))
+                return 'fts5'
+            if dialect == 'postgresql':
+                for statement in POSTGRES_SEARCH_DDL:
+                    conn.execute(text(statement))
+                return 'trgm'
+    except DBAPIError:
+        pass
+    return 'like'
+
+
+def search_contacts(query, q: str, backend: str):
+    """Filter a ``Contact`` query to name or telephone substrings of ``q``.
+
+    Returns ``(query, rank)`` where ``rank`` is a list of ORDER BY clauses
+    putting the best matches first (empty when unranked).  Queries shorter
+    than ``MIN_TRIGRAM_QUERY`` fall back to a plain ``LIKE``.
+    """
+    if backend == 'fts5' and len(q) >= MIN_TRIGRAM_QUERY:
+        phrase = '"' + q.replace('"', '""') + '"'
+        query = (
+            query.join(_fts, _fts.c.rowid == Contact.id)
+            .filter(text('contacts_fts MATCH :search_phrase').bindparams(search_phrase=phrase))
+        )
+        # bm25: lower is better
+        return query, [_fts.c.rank]
+    query = query.filter(Contact.name.ilike(f'%{q}%') | Contact.telephone.ilike(f'%{q}%'))
+    if backend == 'trgm':
+        # the GIN trigram indexes serve the ILIKE above
+        score = func.greatest(func.word_similarity(q, Contact.name), func.word_similarity(q, Contact.telephone))
+        return query, [score.desc()]
+    return query, []
+
+
+def digits_only(number: str) -> str:
+    """Strip everything but digits, e.g. ``'+31 6 123'`` -> ``'316123'``."""
+    return ''.join(ch for ch in number if ch.isdigit())
+
+
+class PrefixIndex:
+    """Sorted name and number keys answering prefix queries by bisection.
+
+    Every word start of a name is indexed, so ``'vri'`` finds ``'Jan de
+    Vries'``.  Numbers are indexed by their digits only, so typing ``'3161'``
+    finds ``'+31 6 1234'``.  A lookup costs ``O(log n + matches)``.
+    """
+
+    def __init__(self, rows: Iterable[tuple[int, str, str]]) -> None:
+        names: list[tuple[str, int]] = []
+        numbers: list[tuple[str, int]] = []
+        self._contacts: dict[int, tuple[str, str]] = {}
+        for contact_id, name, telephone in rows:
+            self._contacts[contact_id] = (name, telephone)
+            words = name.casefold().split()
+            for i in range(len(words)):
+                names.append((' '.join(words[i:]), contact_id))
+            numbers.append((digits_only(telephone), contact_id))
+        names.sort()
+        numbers.sort()
+        self._names = names
+        self._numbers = numbers
+
+    @classmethod
+    def load(cls, session_factory) -> 'PrefixIndex':
+        session = session_factory()
+        try:
+            rows = (
+                session.query(Contact.id, Contact.name, Contact.telephone)
+                .filter(Contact.active == True)  # noqa: E712
+                .yield_per(1000)
+            )
+            return cls(rows)
+        finally:
+            session.close()
+
+    @staticmethod
+    def _scan(keys: list[tuple[str, int]], prefix: str) -> Iterable[int]:
+        i = bisect_left(keys, (prefix,))
+        while i < len(keys) and keys[i][0].startswith(prefix):
+            yield keys[i][1]
+            i += 1
+
+    def search(self, text: str, limit: int = 50) -> list[tuple[str, str]]:
+        """Return ``(name, telephone)`` pairs matching ``text``, ordered by name."""
+        text = ' '.join(text.casefold().split())
+        if not text:
+            return []
+        ids = set(self._scan(self._names, text))
+        number = digits_only(text)
+        if number and number == text.replace(' ', '').lstrip('+'):
+            ids.update(self._scan(self._numbers, number))
+        matches = sorted(self._contacts[i] for i in ids)
+        return matches[:limit]
+
+
+class NumberIndex:
+    """Hash index answering caller-ID lookups from normalized digits.
+
+    Numbers are keyed by their digits (see :func:`number_digits`) and by
+    their last ``suffix_digits`` digits, so ``+31 6 1234 5678`` and
+    ``06 1234 5678`` find each other.  Covers active contacts and the phone
+    numbers of practices, suppliers and contact persons.
+    """
+
+    def __init__(self, entries: Iterable[tuple[str, dict]], suffix_digits: int = 9) -> None:
+        self._suffix_digits = suffix_digits
+        self._exact: dict[str, list[dict]] = {}
+        self._suffix: dict[str, list[dict]] = {}
+        for digits, entry in entries:
+            if not digits:
+                continue
+            self._exact.setdefault(digits, []).append(entry)
+            if len(digits) >= suffix_digits:
+                self._suffix.setdefault(digits[-suffix_digits:], []).append(entry)
+
+    @classmethod
+    def load(cls, session_factory, suffix_digits: int = 9) -> 'NumberIndex':
+        session = session_factory()
+        try:
+            def entries():
+                contacts = (
+                    session.query(Contact.id, Contact.name, Contact.telephone, Contact.telephone_digits)
+                    .filter(Contact.active == True)  # noqa: E712
+                    .yield_per(1000)
+                )
+                for contact_id, name, telephone, digits in contacts:
+                    yield digits, {'kind': 'contact', 'id': contact_id, 'name': name, 'telephone': telephone}
+                owners = (
+                    ('practice', Practice, Practice.name),
+                    ('supplier', Supplier, Supplier.name),
+                    ('person', ContactPerson, ContactPerson.first_name + ' ' + ContactPerson.last_name),
+                )
+                for kind, model, name_column in owners:
+                    rows = (
+                        session.query(model.id, name_column, PhoneNumber.number, PhoneNumber.number_digits)
+                        .join(PhoneNumber, model.phone_numbers)
+                        .yield_per(1000)
+                    )
+                    for owner_id, name, number, digits in rows:
+                        yield digits, {'kind': kind, 'id': owner_id, 'name': name, 'telephone': number}
+
+            return cls(entries(), suffix_digits)
+        finally:
+            session.close()
+
+    def lookup(self, number: str) -> tuple[str | None, list[dict]]:
+        """Return ``('exact' | 'suffix' | None, matches)`` for ``number``.
+
+        Exact digit matches win; otherwise numbers sharing the last
+        ``suffix_digits`` digits match, e.g. with or without country code.
+        """
+        digits = number_digits(number)
+        matches = self._exact.get(digits)
+        if matches:
+            return 'exact', matches
+        if len(digits) >= self._suffix_digits:
+            matches = self._suffix.get(digits[-self._suffix_digits:])
+            if matches:
+                return 'suffix', matches
+        return None, []
@@ -0,0 +1,141 @@
+"""In-process telemetry for phone polls of the ``/phonebook`` endpoints."""
+
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from threading import Lock
+from time import monotonic, time
+from typing import Iterable, Iterator
+
+# Bound memory when many distinct addresses poll; the rest share one bucket.
+MAX_CLIENTS = 5000
+OTHER_CLIENTS = '_other'
+
+
+class _Counters:
+    __slots__ = ('requests', 'not_modified', 'bytes_sent', 'duration_total', 'duration_max',
+                 'first_seen', 'last_seen', 'statuses', 'user_agent')
+
+    def __init__(self, now: float) -> None:
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+        self.first_seen = now
+        self.last_seen = now
+        self.statuses: dict[int, int] = {}
+        self.user_agent = ''
+
+    def add(self, now: float, status: int, nbytes: int, duration: float) -> None:
+        self.requests += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status == 304:
+            self.not_modified += 1
+        self.bytes_sent += nbytes
+        self.duration_total += duration
+        self.duration_max = max(self.duration_max, duration)
+        self.last_seen = now
+
+    def _common(self) -> dict:
+        return {
+            'requests': self.requests,
+            'not_modified_ratio': round(self.not_modified / self.requests, 3) if self.requests else 0.0,
+            'bytes_sent': self.bytes_sent,
+            # request start to last byte sent: includes the network transfer
+            'duration_ms_avg': round(1000 * self.duration_total / self.requests, 2) if self.requests else 0.0,
+            'duration_ms_max': round(1000 * self.duration_max, 2),
+        }
+
+    def endpoint_snapshot(self, now: float) -> dict:
+        elapsed = max(now - self.first_seen, 1.0)
+        data = self._common()
+        data['per_minute'] = round(60 * self.requests / elapsed, 2)
+        data['status'] = {str(code): count for code, count in sorted(self.statuses.items())}
+        return data
+
+    def client_snapshot(self) -> dict:
+        data = self._common()
+        # mean time between polls: what the phone's refresh interval really is
+        if self.requests > 1:
+            data['poll_interval_s'] = round((self.last_seen - self.first_seen) / (self.requests - 1), 1)
+        data['last_seen'] = datetime.fromtimestamp(self.last_seen, tz=timezone.utc).isoformat()
+        data['user_agent'] = self.user_agent
+        return data
+
+
+class PollStats:
+    """Aggregate request rate, 304 ratio, bytes sent and request duration.
+
+    Recording a request is a dict lookup and a few additions under a lock,
+    so it is cheap enough to leave on for every poll.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._started = time()
+        self._endpoints: dict[str, _Counters] = {}
+        self._clients: dict[str, _Counters] = {}
+
+    def record(
+        self,
+        endpoint: str,
+        client: str,
+        user_agent: str,
+        status: int,
+        nbytes: int,
+        duration: float,
+    ) -> None:
+        now = time()
+        with self._lock:
+            counters = self._endpoints.get(endpoint)
+            if counters is None:
+                counters = self._endpoints[endpoint] = _Counters(now)
+            counters.add(now, status, nbytes, duration)
+            if client not in self._clients and len(self._clients) >= MAX_CLIENTS:
+                client = OTHER_CLIENTS
+            counters = self._clients.get(client)
+            if counters is None:
+                counters = self._clients[client] = _Counters(now)
+            counters.add(now, status, nbytes, duration)
+            counters.user_agent = user_agent
+
+    def snapshot(self) -> dict:
+        now = time()
+        with self._lock:
+            return {
+                'uptime_s': round(now - self._started),
+                'endpoints': {name: c.endpoint_snapshot(now) for name, c in sorted(self._endpoints.items())},
+                'clients': {name: c.client_snapshot() for name, c in sorted(self._clients.items())},
+            }
+
+
+class CountingIterable:
+    """Pass a response body through, counting bytes and calling back once.
+
+    ``on_close(nbytes, duration)`` fires when the server closes the body, so
+    streamed responses are measured until the last chunk was sent.
+    """
+
+    def __init__(self, body: Iterable[bytes], started: float, on_close) -> None:
+        self._body = body
+        self._started = started
+        self._on_close = on_close
+        self._nbytes = 0
+        self._closed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._body:
+            self._nbytes += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._on_close(self._nbytes, monotonic() - self._started)
@@ -1,9 +1,31 @@
+import base64
+import json
 import re
+from typing import Sequence
 from flask import flash
 
 # Accept phone numbers with optional spaces, e.g. "+31 6 28330622"
 # First check allowed characters (digits, spaces and an optional leading plus)
 PHONE_RE = re.compile(r'^\+?[0-9 ]+$')
+# Largest value the databases accept for an INTEGER, OFFSET or LIMIT.
+MAX_SQL_INT = 2 ** 63 - 1
+
+
+def normalize_number(telephone: str | None) -> str:
+    """Canonical form used to match numbers, e.g. ``'0031 6 123'`` -> ``'+316123'``.
+
+    Spaces and the usual separators are dropped and an international
+    ``00`` prefix becomes ``+``.
+    """
+    number = ''.join(ch for ch in telephone or '' if ch.isdigit() or ch == '+')
+    if number.startswith('00'):
+        number = '+' + number[2:]
+    return number
+
+
+def number_digits(telephone: str | None) -> str:
+    """Digits of the canonical number, e.g. ``'0031 6 123'`` -> ``'316123'``."""
+    return normalize_number(telephone).replace('+', '')
 
 
 def validate_contact_data(name: str | None, telephone: str | None):
@@ -36,3 +58,46 @@ def validate_contact(name: str | None, telephone: str | None) -> bool:
         for msg in messages:
             flash(msg, 'error')
     return valid
+
+
+def parse_since(value: str | None) -> int | None:
+    """Parse a ``?since=`` change token; ``None`` when absent.
+
+    Tokens are the data version handed out in the ``X-Change-Token``
+    header.  Raises ``ValueError`` for anything else.
+    """
+    if value is None or value == '':
+        return None
+    if not (value.isascii() and value.isdigit()) or int(value) > MAX_SQL_INT:
+        raise ValueError(f'invalid change token {value!r}')
+    return int(value)
+
+
+def encode_cursor(values) -> str:
+    """Opaque page cursor holding the sort key values of the last row."""
+    data = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def parse_cursor(value: str | None, types: Sequence[type]) -> list | None:
+    """Decode a cursor made by :func:`encode_cursor`; ``None`` when absent.
+
+    Raises ``ValueError`` unless it holds one value of each of ``types``
+    (the Python types of the key columns), with integers the database can
+    store.
+    """
+    if value is None or value == '':
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    except (ValueError, TypeError) as exc:
+        raise ValueError(f'invalid cursor {value!r}') from exc
+    if (
+        not isinstance(values, list)
+        or len(values) != len(types)
+        # ``type() is`` so ``True`` does not pass for an int
+        or not all(type(v) is t for v, t in zip(values, types))
+        or not all(-MAX_SQL_INT - 1 <= v <= MAX_SQL_INT for v in values if type(v) is int)
+    ):
+        raise ValueError(f'invalid cursor {value!r}')
+    return values
@@ -0,0 +1,22 @@
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+TABLES = ('contacts', 'practices', 'suppliers', 'contact_persons', 'phone_numbers')
+
+
+def upgrade() -> None:
+    for table in TABLES:
+        op.add_column(table, sa.Column('change_seq', sa.Integer(), nullable=False, server_default='0'))
+        op.create_index(f'ix_{table}_change_seq', table, ['change_seq'])
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        op.drop_index(f'ix_{table}_change_seq', table_name=table)
+        op.drop_column(table, 'change_seq')
@@ -0,0 +1,59 @@
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+# keep in sync with app/search.py
+SQLITE_UPGRADE = (
+    "CREATE VIRTUAL TABLE contacts_fts USING fts5("
+    "name, telephone, content='contacts', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER contacts_fts_ai AFTER INSERT ON contacts BEGIN "
+    "INSERT INTO contacts_fts(rowid, name, telephone) VALUES (new.id, new.name, new.telephone); END",
+    "CREATE TRIGGER contacts_fts_ad AFTER DELETE ON contacts BEGIN "
+    "INSERT INTO contacts_fts(contacts_fts, rowid, name, telephone) "
+    "VALUES ('delete', old.id, old.name, old.telephone); END",
+    "CREATE TRIGGER contacts_fts_au AFTER UPDATE OF name, telephone ON contacts BEGIN "
+    "INSERT INTO contacts_fts(contacts_fts, rowid, name, telephone) "
+    "VALUES ('delete', old.id, old.name, old.telephone); "
+    "INSERT INTO contacts_fts(rowid, name, telephone) VALUES (new.id, new.name, new.telephone); END",
+    "INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild')",
+)
+SQLITE_DOWNGRADE = (
+    "DROP TRIGGER IF EXISTS contacts_fts_au",
+    "DROP TRIGGER IF EXISTS contacts_fts_ad",
+    "DROP TRIGGER IF EXISTS contacts_fts_ai",
+    "DROP TABLE IF EXISTS contacts_fts",
+)
+POSTGRES_UPGRADE = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_contacts_name_trgm ON contacts USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_contacts_telephone_trgm ON contacts USING gin (telephone gin_trgm_ops)",
+)
+POSTGRES_DOWNGRADE = (
+    "DROP INDEX IF EXISTS ix_contacts_telephone_trgm",
+    "DROP INDEX IF EXISTS ix_contacts_name_trgm",
+)
+
+
+def _run(statements) -> None:
+    for statement in statements:
+        op.execute(statement)
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        _run(SQLITE_UPGRADE)
+    elif dialect == 'postgresql':
+        _run(POSTGRES_UPGRADE)
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        _run(SQLITE_DOWNGRADE)
+    elif dialect == 'postgresql':
+        _run(POSTGRES_DOWNGRADE)
@@ -0,0 +1,38 @@
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+COLUMNS = (('contacts', 'telephone', 'telephone_digits'), ('phone_numbers', 'number', 'number_digits'))
+
+
+def _digits(number):
+    # same as app.utils.number_digits at the time of this revision
+    number = ''.join(ch for ch in number or '' if ch.isdigit() or ch == '+')
+    if number.startswith('00'):
+        number = '+' + number[2:]
+    return number.replace('+', '')
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    for table, source, target in COLUMNS:
+        op.add_column(table, sa.Column(target, sa.String(), nullable=True))
+        op.create_index(f'ix_{table}_{target}', table, [target])
+        t = sa.table(table, sa.column('id'), sa.column(source), sa.column(target))
+        rows = bind.execute(sa.select(t.c.id, t.c[source])).all()
+        if rows:
+            bind.execute(
+                t.update().where(t.c.id == sa.bindparam('_id')).values({target: sa.bindparam('_digits')}),
+                [{'_id': row[0], '_digits': _digits(row[1])} for row in rows],
+            )
+
+
+def downgrade() -> None:
+    for table, _, target in COLUMNS:
+        op.drop_index(f'ix_{table}_{target}', table_name=table)
+        op.drop_column(table, target)
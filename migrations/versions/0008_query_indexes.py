@@ -0,0 +1,33 @@
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+# keep in sync with the indexes declared in app/models.py
+ACTIVE_ONLY = {'sqlite_where': sa.text('active = 1'), 'postgresql_where': sa.text('active')}
+INDEXES = (
+    ('ix_contacts_active_name', 'contacts', ['name', 'id'], ACTIVE_ONLY),
+    ('ix_contacts_active_category_name', 'contacts', ['category', 'name', 'id'], ACTIVE_ONLY),
+    ('ix_practices_name', 'practices', ['name', 'id'], {}),
+    ('ix_suppliers_name', 'suppliers', ['name', 'id'], {}),
+    ('ix_contact_persons_last_name', 'contact_persons', ['last_name', 'id'], {}),
+    ('ix_phone_numbers_practice_id', 'phone_numbers', ['practice_id'], {}),
+    ('ix_phone_numbers_supplier_id', 'phone_numbers', ['supplier_id'], {}),
+    ('ix_phone_numbers_contact_person_id', 'phone_numbers', ['contact_person_id'], {}),
+    ('ix_practice_contacts_contact_id', 'practice_contacts', ['contact_id'], {}),
+    ('ix_supplier_contacts_contact_id', 'supplier_contacts', ['contact_id'], {}),
+)
+
+
+def upgrade() -> None:
+    for name, table, columns, options in INDEXES:
+        op.create_index(name, table, columns, **options)
+
+
+def downgrade() -> None:
+    for name, table, _, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
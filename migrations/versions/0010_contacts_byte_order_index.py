@@ -0,0 +1,21 @@
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+# keep in sync with CONTACTS_BYTE_ORDER_INDEX in app/models.py; SQLite's
+# default collation already orders names byte by byte
+INDEX = 'ix_contacts_active_name_c'
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(f'CREATE INDEX {INDEX} ON contacts (name COLLATE "C", id) WHERE active')
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index(INDEX, table_name='contacts')
@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture
+def capture_sql():
+    """Record ``(statement, parameters)`` of everything an app sends to its database.
+
+    ::
+
+        with capture_sql(app) as statements:
+            client.get('/phonebook/all.xml').get_data()
+
+    Streamed bodies run their queries as they are read, so read them
+    inside the block.
+    """
+    @contextmanager
+    def _capture(app):
+        engine = app.config['SESSION_FACTORY'].kw['bind']
+        statements = []
+
+        def _record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(engine, 'before_cursor_execute', _record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', _record)
+
+    return _capture
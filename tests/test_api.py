@@ -57,3 +57,163 @@ def test_api_crud(client):
     # 404 paths
     assert client.put('/api/contacts/999', json={'name': 'x'}).status_code == 404
     assert client.delete('/api/contacts/999').status_code == 404
+
+
+def test_contacts_since_token(client):
+    alice = client.post('/api/contacts', json={'name': 'Alice', 'telephone': '+311'}).get_json()['id']
+    bob = client.post('/api/contacts', json={'name': 'Bob', 'telephone': '+322'}).get_json()['id']
+    resp = client.get('/api/contacts')
+    token = resp.headers['X-Change-Token']
+    assert client.get(f'/api/contacts?since={token}').get_json() == []
+
+    client.put(f'/api/contacts/{alice}', json={'telephone': '+333'})
+    client.delete(f'/api/contacts/{bob}')
+    client.post('/add', data={'name': 'Carol', 'telephone': '+344'})
+    resp = client.get(f'/api/contacts?since={token}')
+    changes = resp.get_json()
+    assert [(c['name'], c['active']) for c in changes] == [('Alice', True), ('Bob', False), ('Carol', True)]
+    assert int(resp.headers['X-Change-Token']) == int(token) + 3
+
+    csv_resp = client.get(f'/export/contacts.csv?since={token}')
+    lines = csv_resp.get_data(as_text=True).splitlines()
+    assert lines[0] == 'id,name,telephone,category,active,change_seq'
+    assert [line.split(',')[1:5] for line in lines[1:]] == [
+        ['Alice', '+333', 'other', '1'], ['Bob', '+322', 'other', '0'], ['Carol', '+344', 'other', '1'],
+    ]
+    assert csv_resp.headers['X-Change-Token'] == resp.headers['X-Change-Token']
+
+    practice = client.post('/api/practices', json={'name': 'Practice'}).get_json()['id']
+    token = client.get('/api/contacts').headers['X-Change-Token']
+    client.post(f'/api/practices/{practice}/phones', json={'number': '+355'})
+    cards = client.get(f'/export/directory.vcf?since={token}').get_data(as_text=True)
+    assert 'FN:Practice' in cards and 'TEL;TYPE=VOICE:+355' in cards
+    assert client.get('/api/contacts?since=abc').status_code == 400
+    # tokens past the database's integers are rejected before reaching SQL
+    assert client.get('/api/contacts?since=99999999999999999999').status_code == 400
+    assert client.get('/export/contacts.csv?since=99999999999999999999').status_code == 400
+    assert client.get('/export/directory.vcf?since=99999999999999999999').status_code == 400
+
+    # a delete cannot be sent as a changed card: feeds from before it resync
+    other = client.post('/api/practices', json={'name': 'Other'}).get_json()['id']
+    token = client.get('/api/contacts').headers['X-Change-Token']
+    resp = client.get(f'/export/directory.vcf?since={token}')
+    assert resp.get_data() == b'' and 'X-Full-Resync' not in resp.headers
+    client.delete(f'/api/practices/{other}')
+    resp = client.get(f'/export/directory.vcf?since={token}')
+    cards = resp.get_data(as_text=True)
+    assert resp.headers['X-Full-Resync'] == '1' and int(resp.headers['X-Change-Token']) == int(token) + 1
+    assert 'FN:Practice' in cards and 'FN:Other' not in cards
+    resp = client.get(f"/export/directory.vcf?since={resp.headers['X-Change-Token']}")
+    assert resp.get_data() == b'' and 'X-Full-Resync' not in resp.headers
+
+    # contact cards carry no id to match a delta on: always a full resync
+    resp = client.get(f'/export/contacts.vcf?since={token}')
+    assert resp.headers['X-Full-Resync'] == '1'
+    assert resp.get_data() == client.get('/export/contacts.vcf').get_data()
+    assert 'X-Full-Resync' not in client.get('/export/contacts.vcf').headers
+    assert client.get('/export/contacts.vcf?since=abc').status_code == 400
+
+
+def test_list_streaming_modes(client):
+    import json
+
+    for i in range(3):
+        client.post('/api/contacts', json={'name': f'C{i}', 'telephone': f'+31{i}'})
+    client.post('/api/practices', json={'name': 'P', 'email': 'p@example.com'})
+    plain = client.get('/api/contacts').get_json()
+
+    resp = client.get('/api/contacts', headers={'Accept': 'application/x-ndjson'})
+    assert resp.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in resp.get_data(as_text=True).splitlines()] == plain
+    assert 'X-Change-Token' in resp.headers
+
+    resp = client.get('/api/contacts?stream=1')
+    assert resp.is_streamed and resp.get_json() == plain
+    assert client.get('/api/practices?stream=1').get_json() == [{'id': 1, 'name': 'P', 'email': 'p@example.com'}]
+    assert client.get('/api/suppliers?stream=1').get_json() == []
+    assert client.get('/api/contact-persons', headers={'Accept': 'application/x-ndjson'}).data == b''
+
+
+def test_contact_search_is_indexed_and_ranked(client, capture_sql):
+    app = client.application
+    assert app.config['SEARCH_BACKEND'] == 'fts5'
+    for name, tel in [('Bob', '+31611111111'), ('Alice Bobbington', '+31622222222'), ('Carol', '+31633333333')]:
+        client.post('/api/contacts', json={'name': name, 'telephone': tel})
+
+    with capture_sql(app) as statements:
+        names = [c['name'] for c in client.get('/api/contacts?q=bob').get_json()]
+    assert names == ['Bob', 'Alice Bobbington']
+    assert any('contacts_fts MATCH' in s for s, _ in statements)
+
+    # number substrings, triggers on update and soft-delete filtering
+    assert [c['name'] for c in client.get('/api/contacts?q=6333').get_json()] == ['Carol']
+    carol = client.get('/api/contacts?q=carol').get_json()[0]['id']
+    client.put(f'/api/contacts/{carol}', json={'name': 'Caroline'})
+    assert [c['name'] for c in client.get('/api/contacts?q=line').get_json()] == ['Caroline']
+    client.delete(f'/api/contacts/{carol}')
+    assert client.get('/api/contacts?q=line').get_json() == []
+    # too short for trigrams: plain LIKE
+    assert [c['name'] for c in client.get('/api/contacts?q=li').get_json()] == ['Alice Bobbington']
+
+
+def test_caller_id_lookup(client):
+    app = client.application
+    client.post('/api/contacts', json={'name': 'Bob', 'telephone': '06 1234 5678'})
+    practice = client.post('/api/practices', json={'name': 'Smile'}).get_json()['id']
+    client.post(f'/api/practices/{practice}/phones', json={'number': '+31 30 123 4567'})
+
+    resp = client.get('/api/lookup', query_string={'number': '0612345678'}).get_json()
+    assert resp['match'] == 'exact' and resp['results'][0]['name'] == 'Bob'
+    resp = client.get('/api/lookup', query_string={'number': '+31612345678'}).get_json()
+    assert resp['match'] == 'suffix' and resp['results'][0]['kind'] == 'contact'
+    resp = client.get('/api/lookup', query_string={'number': '0031301234567'}).get_json()
+    assert resp['match'] == 'exact' and resp['results'] == [
+        {'kind': 'practice', 'id': practice, 'name': 'Smile', 'telephone': '+31 30 123 4567'}
+    ]
+    assert client.get('/api/lookup?number=999').get_json()['results'] == []
+    assert client.get('/api/lookup?number=abc').status_code == 400
+
+    # writes re-warm the index in the background
+    client.post('/api/contacts', json={'name': 'Carol', 'telephone': '+31 6 9999 0000'})
+    app.config['LOOKUP_WARMER'].wait(5)
+    resp = client.get('/api/lookup?number=0699990000').get_json()
+    assert resp['match'] == 'suffix' and resp['results'][0]['name'] == 'Carol'
+
+
+def test_keyset_pagination(client):
+    for name in ['Eve', 'Bob', 'Ann', 'Dan', 'Cas']:
+        client.post('/api/contacts', json={'name': name, 'telephone': '+31 6 12345678'})
+        client.post('/api/suppliers', json={'name': name})
+
+    def _walk(url):
+        names, pages = [], 0
+        while url:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            names += [row['name'] for row in resp.get_json()]
+            pages += 1
+            link = resp.headers.get('Link')
+            assert (link is None) == ('X-Next-Cursor' not in resp.headers)
+            url = link and link[1:link.index('>')]
+        return names, pages
+
+    assert _walk('/api/contacts?limit=2') == (['Ann', 'Bob', 'Cas', 'Dan', 'Eve'], 3)
+    assert _walk('/api/suppliers?limit=2') == (['Ann', 'Bob', 'Cas', 'Dan', 'Eve'], 3)
+    assert _walk('/api/contacts?limit=2&category=other&stream=1')[0] == ['Ann', 'Bob', 'Cas', 'Dan', 'Eve']
+    # the cursor skips past the last row even when rows before it are deleted
+    first = client.get('/api/contacts?limit=2')
+    ann = first.get_json()[0]['id']
+    client.delete(f'/api/contacts/{ann}')
+    rest = client.get(f"/api/contacts?cursor={first.headers['X-Next-Cursor']}").get_json()
+    assert [row['name'] for row in rest] == ['Cas', 'Dan', 'Eve']
+
+    since = client.get('/api/contacts?since=0&limit=4')
+    assert [row['name'] for row in since.get_json()] == ['Eve', 'Bob', 'Dan', 'Cas']
+    assert client.get('/api/contacts?limit=0').status_code == 400
+    assert client.get('/api/contacts?cursor=bogus').status_code == 400
+    # well-formed cursors must still match the key columns' types and range
+    from app.utils import encode_cursor
+    for values in (['Ann', 10 ** 30], ['Ann', 'x'], ['Ann', True], [1, 2], ['Ann']):
+        assert client.get(f'/api/contacts?cursor={encode_cursor(values)}').status_code == 400
+    assert client.get(f"/api/contacts?cursor={encode_cursor(['Ann', 2 ** 63 - 1])}").status_code == 200
+    assert len(client.get('/api/contacts').get_json()) == 4
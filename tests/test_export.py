@@ -1,3 +1,5 @@
+import csv
+import io
 import os
 import os
 import sys
@@ -30,6 +32,13 @@ def test_csv_export(client):
     assert len(text) == 3
 
 
+def test_csv_export_quotes_fields(client):
+    client.post('/add', data={'name': 'Smith, "Dr" Jan', 'telephone': '+311', 'category': 'practice'})
+    resp = client.get('/export/contacts.csv')
+    rows = list(csv.reader(io.StringIO(resp.get_data(as_text=True))))
+    assert rows == [['name', 'telephone', 'category'], ['Smith, "Dr" Jan', '+311', 'practice']]
+
+
 def test_vcf_export(client):
     client.post('/add', data={'name': 'Alice Example', 'telephone': '+311'})
     resp = client.get('/export/contacts.vcf')
@@ -50,3 +59,184 @@ def test_category_xml(client):
     root = ET.fromstring(resp.data)
     names = [e.findtext('Name') for e in root.findall('DirectoryEntry')]
     assert 'S1' in names and 'P1' not in names
+
+
+def test_gzip_variants(client):
+    import gzip
+
+    client.post('/add', data={'name': 'Alice', 'telephone': '+311', 'category': 'practice'})
+    for url in ('/phonebook/all.xml', '/export/contacts.csv', '/export/contacts.vcf'):
+        # first request fills the cache while streaming, second is served from it
+        for _ in range(2):
+            resp = client.get(url, headers={'Accept-Encoding': 'gzip'})
+            assert resp.headers['Content-Encoding'] == 'gzip'
+            assert resp.headers['Vary'] == 'Accept-Encoding'
+            body = resp.get_data()
+            plain = client.get(url)
+            assert 'Content-Encoding' not in plain.headers
+            assert gzip.decompress(body) == plain.data
+            assert resp.headers['ETag'] != plain.headers['ETag']
+        resp = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag']})
+        assert resp.status_code == 304
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+
+
+def test_publish_to_disk(tmp_path):
+    publish_dir = tmp_path / 'www'
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'pb.sqlite'}",
+        'SECRET_KEY': 'test',
+        'PUBLISH_DIR': str(publish_dir),
+    })
+    client = app.test_client()
+    client.post('/add', data={'name': 'Alice', 'telephone': '+311', 'category': 'practice'})
+    app.config['PUBLISHER'].wait(5)
+
+    names = {'root.xml', 'all.xml', 'practices.xml', 'suppliers.xml', 'contacts.csv', 'contacts.vcf'}
+    assert names <= {p.name for p in publish_dir.iterdir()}
+    assert (publish_dir / 'all.xml').read_bytes() == client.get('/phonebook/all.xml').data
+    assert (publish_dir / 'root.xml').read_bytes() == client.get('/phonebook/root.xml').data
+    assert b'Alice' in (publish_dir / 'contacts.csv').read_bytes()
+    assert not [p for p in publish_dir.iterdir() if p.name.startswith('.all.xml')]
+
+    client.post('/api/contacts', json={'name': 'Bob', 'telephone': '+322'})
+    app.config['PUBLISHER'].wait(5)
+    assert b'Bob' in (publish_dir / 'all.xml').read_bytes()
+
+    (publish_dir / 'all.xml').unlink()
+    result = app.test_cli_runner().invoke(args=['publish'])
+    assert result.exit_code == 0
+    assert b'Bob' in (publish_dir / 'all.xml').read_bytes()
+
+
+def test_single_flight_coalesces_cold_renders(client):
+    import threading
+
+    client.post('/add', data={'name': 'Alice', 'telephone': '+311'})
+    flights = client.application.config['RENDER_FLIGHTS']
+    # the leader's body is streamed, so its render is still in flight
+    leader = client.get('/phonebook/all.xml')
+    results = {}
+    other = client.application.test_client()
+    follower = threading.Thread(target=lambda: results.update(resp=other.get('/export/contacts.csv')))
+    follower.start()
+    follower.join(0.2)
+    assert follower.is_alive()
+    assert b'Alice' in leader.get_data()
+    follower.join(5)
+    assert results['resp'].get_data().decode().splitlines()[1] == 'Alice,+311,other'
+    stats = client.get('/stats').get_json()['single_flight']
+    assert stats['coalesced'] == 1 and stats['timeouts'] == 0 and stats['in_flight'] == 0
+    assert flights.leaders == 1
+
+
+def test_single_pass_fills_all_artifacts(client, capture_sql):
+    client.post('/add', data={'name': 'P1', 'telephone': '+111', 'category': 'practice'})
+    client.post('/add', data={'name': 'S1', 'telephone': '+222', 'category': 'supplier'})
+
+    # a cold cache renders every artifact from one query
+    expected = {'/phonebook/practices.xml': client.get('/phonebook/practices.xml').get_data()}
+    with capture_sql(client.application) as statements:
+        for url in ('/phonebook/all.xml', '/phonebook/suppliers.xml', '/export/contacts.csv', '/export/contacts.vcf'):
+            expected[url] = client.get(url).get_data()
+    assert all('contacts' not in s for s, _ in statements)
+    assert b'S1' in expected['/phonebook/suppliers.xml'] and b'P1' not in expected['/phonebook/suppliers.xml']
+    assert expected['/export/contacts.csv'].decode().splitlines() == ['name,telephone,category', 'P1,+111,practice', 'S1,+222,supplier']
+    assert 'FN:S1' in expected['/export/contacts.vcf'].decode()
+
+
+def test_equal_names_keep_insertion_order(client):
+    for telephone in ('+333', '+111', '+222'):
+        client.post('/add', data={'name': 'Same', 'telephone': telephone})
+    expected = ['+333', '+111', '+222']
+    rows = list(csv.reader(io.StringIO(client.get('/export/contacts.csv').get_data(as_text=True))))
+    assert [row[1] for row in rows[1:]] == expected
+    client.application.config['RENDER_CACHE_MAX_ROWS'] = 0
+    client.post('/add', data={'name': 'Other', 'telephone': '+444'})
+    rows = list(csv.reader(io.StringIO(client.get('/export/contacts.csv').get_data(as_text=True))))
+    assert [row[1] for row in rows[2:]] == expected
+
+
+def test_large_directories_stream_uncached(client):
+    client.post('/add', data={'name': 'P1', 'telephone': '+111', 'category': 'practice'})
+    client.post('/add', data={'name': 'S1', 'telephone': '+222', 'category': 'supplier'})
+    cached = {url: client.get(url).get_data() for url in ('/phonebook/all.xml', '/export/contacts.csv', '/export/contacts.vcf')}
+    client.post('/add', data={'name': 'S2', 'telephone': '+333', 'category': 'supplier'})
+    client.application.config['RENDER_CACHE_MAX_ROWS'] = 2
+
+    # above the limit every artifact is read on its own and nothing is kept
+    resp = client.get('/export/contacts.csv')
+    assert resp.get_data() == cached['/export/contacts.csv'] + b'S2,+333,supplier\n'
+    version = int(resp.headers['X-Change-Token'])
+    assert b'S2' in client.get('/phonebook/all.xml').get_data()
+    assert 'FN:S2' in client.get('/export/contacts.vcf').get_data(as_text=True)
+    assert b'S2' in client.get('/phonebook/suppliers.xml').get_data()
+    cache = client.application.config['RENDER_CACHE']
+    assert not any(cache.get(key, version) for key in ('all.xml', 'suppliers.xml', 'contacts.csv'))
+
+
+def test_directory_vcf_export(client, capture_sql):
+    from app.models import Address, ContactPerson, PhoneNumber, Practice, PracticeContact, Supplier
+
+    session = client.application.config['SESSION_FACTORY']()
+    for i in range(3):
+        practice = Practice(name=f'Practice {i}', email=f'p{i}@example.com',
+                            address=Address(street='Main', number=str(i), postal_code='1000 AA', city='Utrecht'))
+        practice.phone_numbers = [PhoneNumber(number=f'+3130{i}', type='work'), PhoneNumber(number=f'+316{i}', type='mobile')]
+        person = ContactPerson(first_name='Jan', last_name=f'Smit, {i}', email=f'jan{i}@example.com', function='Dentist')
+        person.phone_numbers = [PhoneNumber(number=f'+3170{i}')]
+        session.add(PracticeContact(practice=practice, contact=person))
+    session.add(Supplier(name='Acme', phone_numbers=[PhoneNumber(number='+3199')]))
+    session.commit()
+    session.close()
+
+    with capture_sql(client.application) as statements:
+        data = client.get('/export/directory.vcf').get_data(as_text=True)
+    # data version, then per entity type one query plus its selectin loads
+    assert len(statements) <= 11
+    assert data.count('BEGIN:VCARD') == 7
+    assert 'TEL;TYPE=CELL:+3161' in data and 'TEL;TYPE=WORK:+3130' in data
+    assert 'ADR;TYPE=WORK:;;Main 1;Utrecht;;1000 AA;' in data
+    assert 'N:Smit\\, 2;Jan;;;' in data and 'ORG:Practice 2' in data and 'TITLE:Dentist' in data
+
+    persons = client.get('/export/directory.vcf?category=person').get_data(as_text=True)
+    assert persons.count('BEGIN:VCARD') == 3 and 'CATEGORIES:practice' not in persons
+    acme = client.get('/export/directory.vcf?organization=acme').get_data(as_text=True)
+    assert acme.count('BEGIN:VCARD') == 1 and 'TEL;TYPE=VOICE:+3199' in acme
+    assert client.get('/export/directory.vcf?category=bogus').status_code == 400
+
+    # practice writes through the API invalidate the cached export
+    client.post('/api/practices', json={'name': 'New Practice'})
+    assert 'FN:New Practice' in client.get('/export/directory.vcf').get_data(as_text=True)
+
+
+def test_export_job_bundle(tmp_path):
+    import zipfile
+
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "pb.sqlite"}',
+                      'EXPORT_DIR': str(tmp_path / 'exports')})
+    client = app.test_client()
+    client.post('/add', data={'name': 'Alice', 'telephone': '+311', 'category': 'practice'})
+    client.post('/add', data={'name': 'Bob', 'telephone': '+322', 'category': 'supplier'})
+
+    resp = client.post('/export/jobs')
+    assert resp.status_code == 202
+    job_id = resp.get_json()['id']
+    assert app.config['EXPORT_JOBS'].wait(app.config['EXPORT_JOBS'].get(job_id), 5)
+    status = client.get(resp.headers['Location']).get_json()
+    assert status['status'] == 'done' and status['progress'] == 1.0
+
+    data = client.get(status['download_url']).data
+    with zipfile.ZipFile(io.BytesIO(data)) as bundle:
+        assert 'all/phonebook.xml' in bundle.namelist()
+        assert b'Bob' not in bundle.read('practice/contacts.csv')
+        assert b'FN:Bob' in bundle.read('supplier/contacts.vcf')
+    partial = client.get(status['download_url'], headers={'Range': 'bytes=10-19'})
+    assert partial.status_code == 206 and partial.data == data[10:20]
+
+    # unchanged data reuses the bundle; a write starts a new one
+    assert client.post('/export/jobs').get_json()['id'] == job_id
+    client.post('/add', data={'name': 'Carol', 'telephone': '+333'})
+    resp = client.post('/export/jobs')
+    assert resp.status_code == 202 and resp.get_json()['id'] != job_id
@@ -64,6 +64,123 @@ def test_import_contacts(client):
     assert b'John' in response.data and b'Jane' in response.data
 
 
+def test_batched_import_pipeline(client):
+    from app.importer import import_contacts
+
+    rows = ''.join(f'C{i:03},+3161{i:07}\n' for i in range(25))
+    csv_data = 'name,telephone\n' + rows + 'Broken,not-a-number\n'
+    seen = []
+    app = client.application
+    with app.app_context():
+        before = client.get('/api/contacts').headers['X-Change-Token']
+        added = import_contacts(
+            io.StringIO(csv_data),
+            lambda name, tel: tel.startswith('+'),
+            batch_size=10,
+            commit_batches=True,
+            progress=lambda stats: seen.append(stats.to_dict()),
+        )
+    assert added == 25
+    assert [s['inserted'] for s in seen] == [10, 20, 25]
+    assert seen[-1]['rejected'] == 1 and seen[-1]['batches'] == 3
+    # each committed batch is its own change
+    resp = client.get(f'/api/contacts?since={before}')
+    assert int(resp.headers['X-Change-Token']) == int(before) + 3
+    assert len(resp.get_json()) == 25
+
+
+def test_upsert_import(client):
+    client.post('/add', data={'name': 'John', 'telephone': '+31 6 11111111', 'category': 'practice'})
+    client.post('/add', data={'name': 'Jane', 'telephone': '+31622222222'})
+    csv_data = (
+        'name,telephone\n'
+        'John,+31611111111\n'       # same number, formatting differs: update
+        'Jane,0031 622222222\n'     # different formatting, same name: update
+        'Jane,+31622222222\n'       # repeated in file: skip
+        'Piet,+31633333333\n'       # new: insert
+    )
+    data = {'file': (io.BytesIO(csv_data.encode('utf-8')), 'contacts.csv'), 'upsert': '1'}
+    response = client.post('/import', data=data, follow_redirects=True)
+    assert '1 toegevoegd, 2 bijgewerkt, 1 overgeslagen.' in response.data.decode()
+    contacts = {c['name']: c for c in client.get('/api/contacts').get_json()}
+    assert len(contacts) == 3
+    assert contacts['John']['telephone'] == '+31611111111' and contacts['John']['category'] == 'practice'
+
+    data = {'file': (io.BytesIO(csv_data.encode('utf-8')), 'contacts.csv'), 'upsert': '1'}
+    response = client.post('/import', data=data, follow_redirects=True)
+    assert '0 toegevoegd, 0 bijgewerkt, 4 overgeslagen.' in response.data.decode()
+
+
+def test_background_import_job(client):
+    app = client.application
+    app.config['IMPORT_INLINE_MAX_BYTES'] = 0
+    csv_data = "name,telephone\nJohn,+31611111111\nBad,abc\nJane,+31622222222"
+    data = {'file': (io.BytesIO(csv_data.encode('utf-8')), 'contacts.csv')}
+    response = client.post('/import', data=data)
+    assert response.status_code == 302 and '/import/jobs/' in response.location
+    job_id = response.location.rsplit('/', 1)[1]
+    jobs = app.config['IMPORT_JOBS']
+    assert jobs.wait(jobs.get(job_id), 5)
+    assert not jobs.get(job_id).path.exists()
+
+    status = client.get(f'/api/import-jobs/{job_id}').get_json()
+    assert status['status'] == 'done'
+    assert (status['processed'], status['accepted'], status['rejected'], status['inserted']) == (3, 2, 1, 2)
+    page = client.get(response.location)
+    assert page.status_code == 200 and b'contacts.csv' in page.data
+    assert b'Jane' in client.get('/').data
+    assert client.get('/api/import-jobs/unknown').status_code == 404
+
+
+def test_dry_run_import_diff(client):
+    client.post('/add', data={'name': 'John', 'telephone': '+31611111111'})
+    client.post('/add', data={'name': 'Jane', 'telephone': '+31622222222'})
+    csv_data = "name,telephone\nJohn,+31611111111\nJane B,+31 622222222\nPiet,+31633333333\nBad,abc"
+
+    def upload():
+        data = {'file': (io.BytesIO(csv_data.encode('utf-8')), 'contacts.csv'), 'dry_run': '1'}
+        return client.post('/import', data=data)
+
+    response = upload()
+    assert '/import/jobs/' in response.location
+    job_url = response.location
+    status = client.get('/api/import-jobs/' + job_url.rsplit('/', 1)[1]).get_json()
+    assert (status['inserted'], status['updated'], status['skipped'], status['rejected']) == (1, 1, 1, 1)
+    assert len(client.get('/api/contacts').get_json()) == 2
+
+    report = client.get(job_url + '/report.csv').get_data(as_text=True).splitlines()
+    assert report[0] == 'action,name,telephone,contact_id,current_name,current_telephone'
+    assert sorted(line.split(',')[0] for line in report[1:]) == ['add', 'noop', 'update']
+    assert 'update,Jane B,+31 622222222,2,Jane,+31622222222' in report
+
+    response = client.post(job_url + '/apply', follow_redirects=True)
+    assert b'Piet' in response.data and b'Jane B' in response.data
+    response = client.post(job_url + '/apply', follow_redirects=True)
+    assert 'Deze proefimport is al toegepast.' in response.data.decode()
+
+    # a write after the dry run makes its diff stale
+    job_url = upload().location
+    client.post('/add', data={'name': 'Klaas', 'telephone': '+31644444444'})
+    response = client.post(job_url + '/apply', follow_redirects=True)
+    assert 'gewijzigd sinds de proefimport' in response.data.decode()
+
+
+def test_xml_import_streams_input():
+    from app.importer import parse_xml
+
+    units = ''.join(f"<Unit Name='U{i}' Phone1='+31{i}'/>" for i in range(20000))
+    legacy = io.StringIO(f"<YealinkIPPhoneBook><Directory>{units}</Directory></YealinkIPPhoneBook>")
+    rows = parse_xml(legacy)
+    assert next(rows) == ('U0', '+310')
+    # only the first read chunk has been consumed
+    assert legacy.tell() < len(legacy.getvalue()) // 4
+    assert sum(1 for _ in rows) == 19999
+
+    entries = ''.join(f'<DirectoryEntry><Name>E{i}</Name><Telephone>+31{i}</Telephone></DirectoryEntry>' for i in range(3))
+    modern = io.StringIO(f'<YealinkIPPhoneDirectory><Title>x</Title>{entries}</YealinkIPPhoneDirectory>')
+    assert list(parse_xml(modern)) == [('E0', '+310'), ('E1', '+311'), ('E2', '+312')]
+
+
 def test_import_legacy_xml(client):
     xml_data = (
         "<?xml version='1.0' encoding='UTF-8'?>"
@@ -193,6 +310,57 @@ def test_all_xml_with_etag(client):
     assert response2.status_code == 304
 
 
+def test_xml_render_cache(client, capture_sql):
+    """A cached poll only looks up the data version and writes invalidate it."""
+    client.post('/add', data={'name': 'Bob', 'telephone': '+31612345678'})
+    client.get('/phonebook/all.xml').get_data()
+    with capture_sql(client.application) as statements:
+        response = client.get('/phonebook/all.xml')
+    assert b'Bob' in response.data
+    assert len(statements) == 1 and 'data_version' in statements[0][0]
+
+    client.post('/api/contacts', json={'name': 'Carol', 'telephone': '+31622222222'})
+    response = client.get('/phonebook/all.xml')
+    assert b'Carol' in response.data
+
+
+def test_conditional_get_skips_rendering(client, capture_sql):
+    client.post('/add', data={'name': 'Bob', 'telephone': '+31612345678'})
+    for url in ('/phonebook/practices.xml', '/export/contacts.csv', '/export/contacts.vcf'):
+        etag = client.get(url).headers['ETag']
+        with capture_sql(client.application) as statements:
+            response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert len(statements) == 1 and 'data_version' in statements[0][0]
+
+    etag = client.get('/export/contacts.csv').headers['ETag']
+    client.post('/add', data={'name': 'Carol', 'telephone': '+31622222222'})
+    response = client.get('/export/contacts.csv', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_streamed_xml_matches_element_tree(client):
+    """Streaming output must stay byte-identical to ``ET.tostring``."""
+    people = [('A & B <Praktijk>', '+31 6 11111111'), ('Zoë "Z"', '+31622222222'), ("O'Neil", '+311')]
+    for name, telephone in people:
+        client.post('/api/contacts', json={'name': name, 'telephone': telephone})
+    root = ET.Element('YealinkIPPhoneDirectory')
+    for name, telephone in sorted(people):
+        entry = ET.SubElement(root, 'DirectoryEntry')
+        ET.SubElement(entry, 'Name').text = name
+        ET.SubElement(entry, 'Telephone').text = telephone
+    expected = ET.tostring(root, encoding='utf-8', xml_declaration=True)
+    response = client.get('/phonebook/all.xml')
+    assert response.is_streamed
+    assert response.get_data() == expected
+    # second request is served from the cache
+    assert client.get('/phonebook/all.xml').get_data() == expected
+
+    empty = ET.tostring(ET.Element('YealinkIPPhoneDirectory'), encoding='utf-8', xml_declaration=True)
+    assert client.get('/phonebook/suppliers.xml').get_data() == empty
+
+
 def test_root_xml_menu(client):
     response = client.get('/phonebook/root.xml')
     assert response.status_code == 200
@@ -223,3 +391,190 @@ def test_auto_import(tmp_path):
         contacts = load_phonebook()
     assert len(contacts) == 1
     assert contacts[0]['name'] == 'Alice'
+
+
+def test_paged_directory_and_alpha_index(tmp_path, capture_sql):
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'pb.sqlite'}",
+        'SECRET_KEY': 'test',
+        'PHONEBOOK_PAGE_SIZE': 2,
+        'PHONEBOOK_ALPHA_INDEX': True,
+    })
+    client = app.test_client()
+    for name in ('Anna', 'bert', 'Carla', 'Dirk', 'Wim'):
+        client.post('/api/contacts', json={'name': name, 'telephone': '+31611111111'})
+
+    def _parse(url):
+        root = ET.fromstring(client.get(url).get_data())
+        names = [e.findtext('Name') for e in root.findall('DirectoryEntry')]
+        links = {mi.findtext('Name'): mi.findtext('URL') for mi in root.findall('MenuItem')}
+        return names, links
+
+    names, links = _parse('/phonebook/all.xml')
+    assert names == ['Anna', 'Carla']
+    assert links == {'Next': '/phonebook/all.xml?page=2'}
+    names, links = _parse(links['Next'])
+    assert names == ['Dirk', 'Wim']
+    names, links = _parse(links['Next'])
+    assert names == ['bert'] and set(links) == {'Previous'}
+
+    _, links = _parse('/phonebook/root.xml')
+    assert links['A-Z'] == '/phonebook/index.xml'
+    _, letters = _parse(links['A-Z'])
+    assert letters['A-C'] == '/phonebook/index/A-C.xml'
+    names, _ = _parse(letters['A-C'])
+    assert names == ['Anna', 'Carla']
+    names, links = _parse('/phonebook/index/A-C.xml?page=2')
+    assert names == ['bert']
+    assert client.get('/phonebook/index/C-A.xml').status_code == 404
+
+    # both cases of a letter range are index seeks, not an index walk
+    with capture_sql(app) as statements:
+        client.get('/phonebook/index/D-F.xml')
+    statements = [(statement, parameters) for statement, parameters in statements if 'contacts.name >=' in statement]
+    engine = app.config['SESSION_FACTORY'].kw['bind']
+    with engine.connect() as conn:
+        plan = [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statements[0][0], statements[0][1])]
+    assert [line for line in plan if line.startswith(('SCAN', 'SEARCH'))] == [
+        'SEARCH contacts USING INDEX ix_contacts_active_name (name>? AND name<?)'
+    ] * 2
+
+    # pages past any possible OFFSET are rejected up front
+    assert client.get('/phonebook/all.xml?page=99999999999999999999').status_code == 400
+
+
+def test_search_xml_prefix(client):
+    client.post('/api/contacts', json={'name': 'Jan de Vries', 'telephone': '+31 6 12345678'})
+    client.post('/api/contacts', json={'name': 'Janneke', 'telephone': '+31 20 7654321'})
+    client.post('/api/contacts', json={'name': 'Piet', 'telephone': '+32 6 1111'})
+
+    def _names(q):
+        root = ET.fromstring(client.get('/phonebook/search.xml', query_string={'q': q}).data)
+        return [e.findtext('Name') for e in root.findall('DirectoryEntry')]
+
+    assert _names('jan') == ['Jan de Vries', 'Janneke']
+    assert _names('VRI') == ['Jan de Vries']
+    assert _names('+31 6') == ['Jan de Vries']
+    assert _names('3120') == ['Janneke']
+    assert _names('ries') == []
+    assert _names('') == []
+    # index follows writes
+    client.post('/api/contacts', json={'name': 'Jantje', 'telephone': '+31 6 99999999'})
+    assert _names('jant') == ['Jantje']
+
+
+def test_poll_telemetry(client):
+    client.post('/add', data={'name': 'Bob', 'telephone': '+31612345678'})
+    headers = {'User-Agent': 'Yealink SIP-T46S 66.84.0.15'}
+    first = client.get('/phonebook/all.xml', headers=headers)
+    size = len(first.get_data())
+    first.close()
+    etag = first.headers['ETag']
+    for _ in range(3):
+        client.get('/phonebook/all.xml', headers={**headers, 'If-None-Match': etag}).close()
+
+    stats = client.get('/stats').get_json()['polls']
+    endpoint = stats['endpoints']['/phonebook/all.xml']
+    assert endpoint['requests'] == 4
+    assert endpoint['status'] == {'200': 1, '304': 3}
+    assert endpoint['not_modified_ratio'] == 0.75
+    assert endpoint['bytes_sent'] == size
+    assert endpoint['duration_ms_max'] >= endpoint['duration_ms_avg'] > 0
+    client_stats = stats['clients']['127.0.0.1']
+    assert client_stats['requests'] == 4
+    assert client_stats['user_agent'].startswith('Yealink')
+    assert 'poll_interval_s' in client_stats
+
+
+def test_index_pages_in_sql(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "pb.sqlite"}',
+        'CONTACTS_PAGE_SIZE': 2,
+    })
+    client = app.test_client()
+    for name, category in [('Ann', 'other'), ('Bea', 'supplier'), ('Cas', 'other'), ('Dirk', 'supplier'), ('Eva', 'other')]:
+        client.post('/add', data={'name': name, 'telephone': '+31 6 12345678', 'category': category})
+
+    def _page(url):
+        soup = BeautifulSoup(client.get(url).data, 'html.parser')
+        items = [(i.select_one('.contact-name').get_text(), int(i['data-id'])) for i in soup.select('.contact-item')]
+        return items, {a.get_text().strip('←→ '): a['href'] for a in soup.select('nav a')}
+
+    session = app.config['SESSION_FACTORY']()
+    ids = dict(session.query(Contact.name, Contact.id))
+    session.close()
+    items, links = _page('/')
+    assert items == [('Ann', ids['Ann']), ('Bea', ids['Bea'])] and 'Volgende' in links and 'Vorige' not in links
+    items, links = _page(links['Volgende'])
+    assert items == [('Cas', ids['Cas']), ('Dirk', ids['Dirk'])] and 'Vorige' in links
+    assert _page('/?page=3')[0] == [('Eva', ids['Eva'])]
+
+    # filtered rows link to the edit and delete routes by id
+    items, links = _page('/?category=supplier')
+    assert items == [('Bea', ids['Bea']), ('Dirk', ids['Dirk'])] and not links
+    items, _ = _page('/?q=ir')
+    assert items == [('Dirk', ids['Dirk'])]
+    soup = BeautifulSoup(client.get('/?q=ir').data, 'html.parser')
+    assert soup.select_one('.contact-item a')['href'] == f"/contacts/{ids['Dirk']}/edit"
+    client.post(f"/contacts/{ids['Dirk']}/edit", data={'name': 'Dirk', 'telephone': '+31 6 99999999', 'category': 'other'})
+    assert _page('/?category=supplier')[0] == [('Bea', ids['Bea'])]
+    assert client.delete(f"/contacts/{ids['Bea']}/delete").status_code == 204
+    assert client.get(f"/contacts/{ids['Bea']}/edit").status_code == 404
+    assert client.delete(f"/contacts/{ids['Bea']}/delete").status_code == 404
+    assert client.get('/edit/5').status_code == 404
+
+    # ids, positions and pages beyond the database's integers are not found, not errors
+    huge = 10 ** 20
+    assert client.get(f'/contacts/{huge}/edit').status_code == 404
+    assert client.delete(f'/contacts/{huge}/delete').status_code == 404
+    assert client.get(f'/edit/{huge}').status_code == 404
+    assert client.delete(f'/delete/{huge}').status_code == 404
+    assert client.post(f'/delete/{huge}').status_code == 302
+    assert client.get(f'/?page={huge}').status_code == 400
+
+
+def test_jobs_are_visible_to_other_workers(tmp_path):
+    config = {
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "pb.sqlite"}',
+        'IMPORT_SPOOL_DIR': str(tmp_path / 'imports'),
+        'EXPORT_DIR': str(tmp_path / 'exports'),
+    }
+    # two app instances stand in for two worker processes
+    first, second = create_app(config), create_app(config)
+    client, other = first.test_client(), second.test_client()
+    client.post('/add', data={'name': 'John', 'telephone': '+31611111111'})
+
+    csv_data = "name,telephone\nJohn,+31611111111\nPiet,+31633333333"
+    data = {'file': (io.BytesIO(csv_data.encode('utf-8')), 'contacts.csv'), 'dry_run': '1'}
+    job_url = client.post('/import', data=data).location
+    job_id = job_url.rsplit('/', 1)[1]
+    status = other.get(f'/api/import-jobs/{job_id}').get_json()
+    assert status['status'] == 'done' and status['inserted'] == 1
+    assert other.get(job_url).status_code == 200
+    assert 'add,Piet' in other.get(job_url + '/report.csv').get_data(as_text=True)
+
+    response = other.post(job_url + '/apply', follow_redirects=True)
+    assert b'Piet' in response.data
+    response = client.post(job_url + '/apply', follow_redirects=True)
+    assert 'Deze proefimport is al toegepast.' in response.data.decode()
+    assert client.get(f'/api/import-jobs/{job_id}').get_json()['applied_by'] is not None
+
+    export_id = client.post('/export/jobs').get_json()['id']
+    jobs = first.config['EXPORT_JOBS']
+    assert jobs.wait(jobs.get(export_id), 5)
+    status = other.get(f'/export/jobs/{export_id}').get_json()
+    assert status['status'] == 'done'
+    assert other.get(status['download_url']).status_code == 200
+    assert other.get('/export/jobs/' + 'f' * 32).status_code == 404
+
+    # a newer bundle built by the other worker prunes this one everywhere
+    other.post('/add', data={'name': 'Kees', 'telephone': '+31644444444'})
+    newer = second.config['EXPORT_JOBS']
+    assert newer.wait(newer.get(other.post('/export/jobs').get_json()['id']), 5)
+    assert client.get(f'/export/jobs/{export_id}').status_code == 404
+    assert client.get(status['download_url']).status_code == 404
+    assert export_id not in jobs._jobs
+    assert other.get('/api/import-jobs/..%2F..%2Fetc').status_code == 404
@@ -0,0 +1,235 @@
+"""EXPLAIN every SELECT the hot read paths issue and fail on full scans.
+
+Runs against SQLite, and against PostgreSQL too when
+``PHONEBOOK_TEST_POSTGRES_URI`` points at an empty scratch database.
+"""
+
+import os
+import sys
+import tempfile
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app
+from app.models import (
+    Base,
+    Contact,
+    ContactPerson,
+    PhoneNumber,
+    Practice,
+    PracticeContact,
+    Supplier,
+    SupplierContact,
+)
+
+DATABASES = ['sqlite']
+if os.environ.get('PHONEBOOK_TEST_POSTGRES_URI'):
+    DATABASES.append('postgresql')
+
+# (method, url) pairs; ``{next}`` is replaced by the previous response's next-page link
+HOT_REQUESTS = [
+    ('GET', '/'),
+    ('GET', '/?page=3'),
+    ('GET', '/?category=supplier'),
+    ('GET', '/?category=supplier&page=2'),
+    ('GET', '/?q=contact 01'),
+    ('GET', '/edit/7'),
+    ('GET', '/contacts/7/edit'),
+    ('GET', '/phonebook/all.xml'),
+    ('GET', '/phonebook/all.xml?page=3'),
+    ('GET', '/phonebook/practices.xml?page=2'),
+    ('GET', '/phonebook/suppliers.xml'),
+    ('GET', '/phonebook/index/A-C.xml'),
+    ('GET', '/phonebook/index/D-F.xml?page=2'),
+    ('GET', '/phonebook/search.xml?q=con'),
+    ('GET', '/export/contacts.csv'),
+    ('GET', '/export/contacts.vcf'),
+    ('GET', '/export/directory.vcf'),
+    ('GET', '/export/contacts.csv?since=250'),
+    ('GET', '/export/directory.vcf?since=250'),
+    ('GET', '/api/contacts?limit=20'),
+    ('GET', '{next}'),
+    ('GET', '/api/contacts?category=practice&limit=20'),
+    ('GET', '{next}'),
+    ('GET', '/api/contacts?since=100&limit=20'),
+    ('GET', '/api/practices?limit=5'),
+    ('GET', '{next}'),
+    ('GET', '/api/suppliers?limit=5'),
+    ('GET', '{next}'),
+    ('GET', '/api/contact-persons?limit=5'),
+    ('GET', '{next}'),
+    ('GET', '/api/practices/1/phones'),
+    ('GET', '/api/practices/1/contacts'),
+    ('GET', '/api/suppliers/1/phones'),
+    ('GET', '/api/suppliers/1/contacts'),
+    ('GET', '/api/contact-persons/1/phones'),
+    # loads the person's phone numbers and links by contact_id
+    ('DELETE', '/api/contact-persons/2'),
+]
+# Unfiltered listings: walking the sort index from its start is the right
+# plan as long as a LIMIT stops it.  Anywhere else a walk means a filter
+# the index cannot seek on.
+ORDERED_WALKS = {
+    '/',
+    '/?page=3',
+    '/edit/7',
+    '/phonebook/all.xml',
+    '/phonebook/all.xml?page=3',
+    '/api/contacts?limit=20',
+    '/api/practices?limit=5',
+    '/api/suppliers?limit=5',
+    '/api/contact-persons?limit=5',
+}
+# Read everything on purpose: full exports, rendered once per data version,
+# and the search endpoint's in-process prefix index, built once per version.
+FULL_READS = {
+    '/export/contacts.csv',
+    '/export/contacts.vcf',
+    '/export/directory.vcf',
+    '/phonebook/search.xml?q=con',
+}
+
+
+@pytest.fixture(params=DATABASES)
+def app(request):
+    tmpdir = tempfile.TemporaryDirectory()
+    if request.param == 'sqlite':
+        uri = f"sqlite:///{os.path.join(tmpdir.name, 'pb.sqlite')}"
+    else:
+        uri = os.environ['PHONEBOOK_TEST_POSTGRES_URI']
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': uri,
+        'SECRET_KEY': 'test',
+        'PHONEBOOK_PAGE_SIZE': 20,
+        'PHONEBOOK_ALPHA_INDEX': True,
+    })
+    _seed(app.config['SESSION_FACTORY'])
+    yield app
+    engine = app.config['SESSION_FACTORY'].kw['bind']
+    if request.param != 'sqlite':
+        Base.metadata.drop_all(engine)
+    engine.dispose()
+    tmpdir.cleanup()
+
+
+def _seed(session_factory):
+    session = session_factory()
+    categories = ('practice', 'supplier', 'other')
+    session.add_all(
+        Contact(name=f'Contact {i:03}', telephone=f'+31 6 {i:08}', category=categories[i % 3], active=i % 10 != 0)
+        for i in range(300)
+    )
+    for i in range(20):
+        practice = Practice(name=f'Practice {i:02}')
+        supplier = Supplier(name=f'Supplier {i:02}')
+        person = ContactPerson(first_name='Jan', last_name=f'Smit {i:02}')
+        session.add_all([
+            practice,
+            supplier,
+            person,
+            PhoneNumber(number=f'+31 30 {i:07}', practice=practice),
+            PhoneNumber(number=f'+31 20 {i:07}', supplier=supplier),
+            PhoneNumber(number=f'+31 6 {i:08}', contact_person=person),
+            PracticeContact(practice=practice, contact=person),
+            SupplierContact(supplier=supplier, contact=person),
+        ])
+    session.commit()
+    session.close()
+
+
+def _explain(conn, statement, parameters):
+    """Return the plan lines of ``statement`` as the database would run it."""
+    if conn.dialect.name == 'sqlite':
+        rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[-1] for row in rows]
+    # tiny tables make a sequential scan cheapest; only report it when no index applies
+    conn.exec_driver_sql('SET enable_seqscan = off')
+    try:
+        return [row[0] for row in conn.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+    finally:
+        conn.exec_driver_sql('RESET enable_seqscan')
+
+
+def _full_scans(statement, plan, dialect, ordered_walk):
+    """Plan lines that read a whole table or walk an index without seeking.
+
+    With ``ordered_walk`` an index walk stopped by a LIMIT is accepted.
+    Correlated subqueries are reported too: each one is a seek per outer
+    row, so a page of rows costs a range per row however well it seeks.
+    """
+    walk_ok = ordered_walk and ' LIMIT ' in statement.upper()
+    if dialect == 'sqlite':
+        return [
+            line for line in plan
+            if line.startswith('CORRELATED ')
+            or line.startswith('SCAN ') and 'VIRTUAL TABLE' not in line and line != 'SCAN CONSTANT ROW'
+            and (' USING ' not in line or not walk_ok)
+        ]
+    scans = [line for line in plan if 'Seq Scan' in line or 'SubPlan' in line]
+    if not walk_ok and not any('Index Cond' in line for line in plan):
+        scans += [line for line in plan if 'Index Scan' in line or 'Index Only Scan' in line]
+    return scans
+
+
+def test_hot_queries_use_indexes(app, capture_sql):
+    client = app.test_client()
+    engine = app.config['SESSION_FACTORY'].kw['bind']
+    selects = []
+    link = None
+    for method, url in HOT_REQUESTS:
+        if url == '{next}':
+            url = link[1:link.index('>')]
+        with capture_sql(app) as statements:
+            resp = client.open(url, method=method)
+            # streamed bodies run their queries as they are read
+            resp.get_data()
+            resp.close()
+        assert resp.status_code in (200, 204), url
+        link = resp.headers.get('Link')
+        selects += [
+            (url, statement, parameters) for statement, parameters in statements
+            if statement.lstrip().upper().startswith('SELECT')
+        ]
+
+    assert len({url for url, _, _ in selects}) == len(HOT_REQUESTS)
+    failures = []
+    with engine.connect() as conn:
+        for url, statement, parameters in selects:
+            if url in FULL_READS:
+                continue
+            plan = _explain(conn, statement, parameters)
+            if _full_scans(statement, plan, engine.dialect.name, url in ORDERED_WALKS):
+                failures.append(f'{url}\n  {statement}\n  ' + '\n  '.join(plan))
+    assert not failures, 'full scans:\n' + '\n'.join(failures)
+
+
+def test_letter_slices_match_single_pass(app):
+    """Paged A-Z slices (SQL ranges) hold the rows the single pass routes there."""
+    import xml.etree.ElementTree as ET
+
+    session = app.config['SESSION_FACTORY']()
+    names = ['anna', 'Bob', 'bob', 'Carla', 'Émile', "'t Hooft", 'Dirk', 'zeger', 'Ånger']
+    session.add_all(Contact(name=name, telephone='+31 6 11111111') for name in names)
+    session.commit()
+    session.close()
+    client = app.test_client()
+
+    def _names(url):
+        root = ET.fromstring(client.get(url).get_data())
+        links = {mi.findtext('Name'): mi.findtext('URL') for mi in root.findall('MenuItem')}
+        return [e.findtext('Name') for e in root.findall('DirectoryEntry')], links.get('Next')
+
+    paged = []
+    url = '/phonebook/index/A-C.xml'
+    while url:
+        page, url = _names(url)
+        paged += page
+    app.config['PHONEBOOK_PAGE_SIZE'] = 0
+    single_pass, _ = _names('/phonebook/index/A-C.xml')
+
+    assert paged == single_pass
+    assert len(paged) == len(set(paged))
+    assert {'anna', 'Bob', 'bob', 'Carla'} <= set(paged)
+    assert not {'Émile', "'t Hooft", 'Dirk', 'zeger', 'Ånger'} & set(paged)